@@ -0,0 +1,98 @@
+import numpy as np
+
+SAFETY = 0.5  # fraction of the smallest feature a ball may cross in one step
+# Gap between one step and two half steps that rejects it, as a fraction of the largest displacement. A contact
+# resolved at the end of a step instead of halfway moves a ball by up to its speed along the contact normal times
+# the step, so this rejects the steps where the fastest balls meet about head on
+TOLERANCE = 0.5
+MIN_STEP = 1 / 16  # smallest step, as a fraction of dt
+MAX_STEP = 64  # largest step, as a multiple of dt
+
+
+def segment_point_distance(points, starts, ends):
+    """(points, segments) distances"""
+    directions = ends - starts
+    lengths = np.maximum(np.sum(directions ** 2, axis=1), np.finfo(np.float64).tiny)
+    qx = points[:, None, 0] - starts[:, 0]
+    qy = points[:, None, 1] - starts[:, 1]
+    s = np.clip((qx * directions[:, 0] + qy * directions[:, 1]) / lengths, 0, 1)
+    return np.hypot(qx - s * directions[:, 0], qy - s * directions[:, 1])
+
+
+def feature_size(polygon):
+    """Smallest detail of the board: its shortest edge or the narrowest gap between two edges that do not touch
+
+    The gap between two segments that do not cross is reached at an endpoint of one of them, so it is the smallest
+    distance from a vertex to an edge not ending at that vertex."""
+    polygon = np.asarray(polygon, np.float64)
+    starts, ends = polygon[:, 0:2], polygon[:, 2:4]
+    lengths = np.hypot(*(ends - starts).T)
+    smallest = np.min(lengths[lengths > 0], initial=np.inf)
+    vertices = np.unique(np.concatenate((starts, ends)), axis=0)
+    for start in range(0, vertices.shape[0], 256):
+        points = vertices[start:start + 256]
+        distance = segment_point_distance(points, starts, ends)
+        # Edges ending at the vertex are at distance 0 from it but are no gap
+        touching = np.all(points[:, None] == starts, axis=2) | np.all(points[:, None] == ends, axis=2)
+        distance[touching] = np.inf
+        smallest = min(smallest, np.min(distance, initial=np.inf))
+    return smallest
+
+
+class StepController:
+    """Picks each step from the fastest ball, so that no ball moves further in one step than
+
+    - safety times the board's smallest feature, so a step never bounces a ball between walls more than the swept
+      stepper follows and never skips a thin wall or a narrow gap,
+    - safety times the smallest contact distance when there are collisions, so no contact is stepped over.
+
+    Slow phases (balls damped by mu) get longer steps, within [min_step, max_step] times dt. With collisions, each
+    step is also taken as two half steps: contacts are only resolved at the end of a step, so when any ball ends up
+    further than tolerance times the largest displacement from where the half steps put it, the step is rejected
+    and retried at half the size. Wall bounces are exact at any step size and need no such check."""
+    def __init__(self, polygon, dt, radii=None, safety=SAFETY, tolerance=TOLERANCE, min_step=MIN_STEP,
+                 max_step=MAX_STEP):
+        self.dt = dt
+        self.feature = feature_size(polygon)
+        self.max_displacement = safety * self.feature
+        if radii is not None:
+            self.max_displacement = min(self.max_displacement, safety * np.sqrt(2) * np.min(radii, initial=np.inf))
+        self.tolerance = tolerance * self.max_displacement
+        self.min_step = min_step * dt
+        self.max_step = max_step * dt
+        self.steps = 0
+        self.rejected = 0
+
+    def step_size(self, v):
+        speed = max_speed(v)
+        if speed == 0:
+            return self.max_step
+        return float(np.clip(self.max_displacement / speed, self.min_step, self.max_step))
+
+    def accept(self, x, half_x, h):
+        """Whether a step of h ending at positions x agrees with two half steps ending at half_x (None when there is
+        nothing to check), always at min_step"""
+        if half_x is None or h <= self.min_step or np.max(np.abs(x - half_x), initial=0) <= self.tolerance:
+            self.steps += 1
+            return True
+        self.rejected += 1
+        return False
+
+
+def damping(mu, h, dt):
+    """(mean, final) speed factors over a step of h when speeds decay continuously by mu every dt
+
+    Moving at the mean factor for the whole step covers exactly the distance of the decaying motion, so a step of
+    any length damps like many small ones."""
+    final = mu ** (h / dt)
+    if mu == 1 or h == 0:
+        return 1.0, final
+    return (final - 1) / (h / dt * np.log(mu)), final
+
+
+def max_speed(v):
+    return float(np.sqrt(np.max(np.sum(np.square(v, dtype=np.float64), axis=1), initial=0)))
+
+
+def kinetic_energy(v):
+    return 0.5 * float(np.sum(np.square(v, dtype=np.float64)))
@@ -0,0 +1,84 @@
+import struct
+import sys
+
+import numpy as np
+
+from trajectory import BoardFormat, OutputFile, board_bounds, read_records
+
+# Metrics stream layout (little endian):
+#   magic    8 bytes   b'BWMETRIC'
+#   header   '<HIIIId' version, number of edges, number of balls, occupancy bins along x and y, frame time step
+#   edges    edges x 4 float64, the board as written by physics.py
+#   frames   metrics_dtype records up to the end of the file, one per frame
+# Balls all have the same (unit) mass: the center of mass is the mean position, the kinetic energy 0.5 * sum |v|^2
+# and the momentum sum v. wall_hits counts the bounces off each edge during the frame, occupancy the balls in each
+# cell of a bins grid over the board's bounding box (balls outside it go to the nearest border cell).
+MAGIC = b'BWMETRIC'
+VERSION = 1
+HEADER = struct.Struct('<HIIIId')
+FORMAT = BoardFormat('metrics stream', MAGIC, VERSION, HEADER, edges_field=1)
+OCCUPANCY_BINS = (16, 16)
+
+
+def metrics_dtype(num_edges, bins):
+    return np.dtype([('frame', '<i4'), ('time', '<f8'), ('center', '<f8', (2,)), ('kinetic', '<f8'),
+                     ('momentum', '<f8', (2,)), ('wall_hits', '<i4', (num_edges,)), ('occupancy', '<i4', bins)])
+
+
+class MetricsWriter(OutputFile):
+    """Computes the observables of every frame from the state arrays and appends them as one record"""
+    def __init__(self, path, polygon, num_balls, dt, bins=OCCUPANCY_BINS, offset=None):
+        self.polygon = np.asarray(polygon, np.float64)
+        self.num_balls = num_balls
+        self.dt = dt
+        self.bins = tuple(bins)
+        self.dtype = metrics_dtype(self.polygon.shape[0], self.bins)
+        self.bounds, self.size = board_bounds(self.polygon)
+        self.start(path, offset)
+
+    def open(self, path):
+        file = open(path, 'wb')
+        self.bytes_written = FORMAT.write(file, self.polygon, self.polygon.shape[0], self.num_balls, self.bins[0],
+                                          self.bins[1], self.dt)
+        return file
+
+    def occupancy(self, x):
+        ix = np.clip(((x[:, 0] - self.bounds[0]) / self.size[0] * self.bins[0]).astype(np.int64), 0, self.bins[0] - 1)
+        iy = np.clip(((x[:, 1] - self.bounds[2]) / self.size[1] * self.bins[1]).astype(np.int64), 0, self.bins[1] - 1)
+        return np.bincount(ix * self.bins[1] + iy, minlength=self.bins[0] * self.bins[1]).reshape(self.bins)
+
+    def write_metrics(self, frame, time, x, v, wall_hits):
+        record = np.zeros(1, self.dtype)
+        record['frame'] = frame
+        record['time'] = time
+        record['center'] = np.mean(x, axis=0, dtype=np.float64)
+        record['kinetic'] = 0.5 * np.sum(np.square(v, dtype=np.float64))
+        record['momentum'] = np.sum(v, axis=0, dtype=np.float64)
+        record['wall_hits'] = wall_hits
+        record['occupancy'] = self.occupancy(x)
+        self.bytes_written += self.file.write(record.tobytes())
+
+
+def read_metrics(path):
+    """Board edges (edges, 4), frame time step and the metrics_dtype records of a metrics stream"""
+    with open(path, 'rb') as file:
+        (num_edges, _, bins_x, bins_y, dt), edges = FORMAT.read(file)
+        metrics = read_records(file, metrics_dtype(num_edges, (bins_x, bins_y)))
+    return edges, dt, metrics
+
+
+def export_center_of_mass(metrics_path, path='center_of_mass_data.txt'):
+    """center_of_mass_data.txt as animation_testing writes it: x then y of the center of mass in the viewer's
+    coordinates (normalized to the board), each followed by its frame index"""
+    edges, _, metrics = read_metrics(metrics_path)
+    bounds, size = board_bounds(edges)
+    center_x = (metrics['center'][:, 0] - bounds[0]) / size[0]
+    center_y = (metrics['center'][:, 1] - bounds[2]) / size[1]
+    with open(path, 'w') as file:
+        for center in (center_x, center_y):
+            file.write(''.join(f"{value} {i} " for i, value in enumerate(center.tolist())) + "\n")
+
+
+if __name__ == "__main__":
+    # python analytics.py data.metrics [center_of_mass_data.txt]
+    export_center_of_mass(*sys.argv[1:3])
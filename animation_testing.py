@@ -1,3 +1,5 @@
+import os
+
 import matplotlib.pyplot as plt
 import numpy as np
 
@@ -9,6 +11,10 @@ import matplotlib.font_manager as fm
 
 from matplotlib.widgets import Button
 
+from board_cache import compiled_board
+from archive import is_archive, read_archive
+from trajectory import is_binary, read_trajectory
+
 
 fe = fm.FontEntry(
     fname='Spinnaker-Regular.ttf',
@@ -17,9 +23,11 @@ fm.fontManager.ttflist.insert(0, fe)
 mpl.rcParams['font.family'] = fe.name
 
 BOARD_SIZE = (100, 100)
+DATA_PATH = 'data.traj' if os.path.exists('data.traj') else 'data.txt'
 
 SUB_FRAMES = 1
 animation_speed = 1
+READ_BLOCK = 16 * 1024 * 1024  # bytes of text frames parsed at once
 PAUSE_BUTTON_PATH = "icons/pause.png"
 PLAY_BUTTON_PATH = "icons/play.png"
 
@@ -78,33 +86,44 @@ class Ball(plt.Circle):
         self.y = new_y / BOARD_SIZE[1]
 
 
-def read_data(file_path):
-    frames = []
-    board = []  # list of vertices
+def read_data(file_path, progress=None):
+    """Board vertices and (frames, balls, 5) records of a trajectory, radii scaled up by 1.5 for display
+
+    progress, when given, is called with the bytes read so far and the size of the file while a text trajectory
+    loads."""
+    if is_binary(file_path) or is_archive(file_path):
+        edges, frames = read_trajectory(file_path) if is_binary(file_path) else read_archive(file_path)
+        board = [tuple(vertex) for vertex in edges.reshape(-1, 2).tolist()]
+        frames = frames.astype(np.float64)
+    else:
+        board, frames = read_text(file_path, progress)
+    frames[..., 4] *= 1.5
+    return board, frames
+
+
+def read_text(file_path, progress=None):
+    """Board vertices and (frames, balls, 5) records of a data.txt file, parsed READ_BLOCK bytes of lines at a time"""
+    total = os.path.getsize(file_path)
+    blocks = []
     with open(file_path, 'r') as file:
-        i = 0
-        for line in file:
-            if line == "":
+        values = np.array(file.readline().split(), np.float64)
+        board = [tuple(vertex) for vertex in values.reshape(-1, 2).tolist()]
+        while True:
+            lines = file.readlines(READ_BLOCK)
+            if not lines:
+                break
+            if not any(line.strip() for line in lines):
                 continue
-            if i == 0:
-                data = line.strip().split(' ')
-                for j in range(0, len(data), 2):
-                    x = float(data[j])
-                    y = float(data[j+1])
-                    board.append((x, y))
-            else:
-                frame = []
-                data = line.strip().split(' ')
-                for i in range(0, len(data), 5):
-                    x = float(data[i])
-                    y = float(data[i+1])
-                    vx = float(data[i+2])
-                    vy = float(data[i+3])
-                    r = float(data[i+4]) * 1.5
-                    frame.append((x, y, vx, vy, r))
-                frames.append(frame)
-            i += 1
-    return board, frames
+            # One parse for the whole block, which also rejects frames of different sizes
+            values = np.loadtxt(lines, np.float64, ndmin=2)
+            if values.shape[1] % 5 or (blocks and values.shape[1] != blocks[0].shape[1] * 5):
+                raise ValueError(f"{file_path} has frames of different sizes")
+            blocks.append(values.reshape(values.shape[0], -1, 5))
+            if progress is not None:
+                progress(file.buffer.tell(), total)
+    if not blocks:
+        return board, np.empty((0, 0, 5))
+    return board, np.concatenate(blocks)
 
 
 def get_ball_color(i, max_i):
@@ -161,35 +180,16 @@ def update_trail_items(items, x, y, vx, vy, r, color, first_update=False):
 
 
 def get_board_elements(board_vertices, size=(100, 100)):
-    polygons = []
-    remaining_vertices = [[board_vertices[2 * i], board_vertices[2 * i+1]] for i in range(round(len(board_vertices) / 2))]
-    i = 0
-    while len(remaining_vertices) > 0:
-        vertex = remaining_vertices[0]
-        polygon, remaining_vertices = get_polygon_with_vertex(vertex, remaining_vertices)
-        polygons.append(polygon)
-
-        i += 1
-        if i > 100:
-            print("Too many iterations")
-            break
-    
-    min_x = min([v[0] for v in board_vertices])
-    max_x = max([v[0] for v in board_vertices])
-    min_y = min([v[1] for v in board_vertices])
-    max_y = max([v[1] for v in board_vertices])
-
-    offset_x = -min_x
-    offset_y = -min_y
-    min_x, max_x, min_y, max_y = min_x + offset_x, max_x + offset_x, min_y + offset_y, max_y + offset_y
+    # Outlines and bounds come from the compiled board, built once per board and then read from the cache
+    board = compiled_board(np.array(board_vertices, np.float64).reshape(-1, 4))
+    min_x, max_x, min_y, max_y = board.bounds
     scale_x = size[0] / (max_x - min_x)
     scale_y = size[1] / (max_y - min_y)
 
     # Create the polygons
     polygon_patches = []
-    for polygon in polygons:
-        vertices = [v[0] for v in polygon]
-        scaled_vertices = [((v[0] + offset_x) * scale_x, (v[1] + offset_y) * scale_y) for v in vertices]
+    for vertices in board.loops():
+        scaled_vertices = [((x - min_x) * scale_x, (y - min_y) * scale_y) for x, y in vertices.tolist()]
 
         polygon_patch = plt.Polygon(scaled_vertices, closed=True, edgecolor='#4d3615', facecolor='#264d15', alpha=1)
         polygon_patch.set_linewidth(5)
@@ -198,35 +198,6 @@ def get_board_elements(board_vertices, size=(100, 100)):
     return polygon_patches
 
 
-def get_polygon_with_vertex(vertex, remaining_vertices):
-    new_remaining_vertices = remaining_vertices
-    polygon = [vertex]
-    current_vertex = vertex
-    remaining_vertices.remove(vertex)
-
-    i = 0
-    while True:
-        found_next = False
-        returns_to_start = False
-        for vertex in remaining_vertices:
-            if vertex[0] == current_vertex[1]:
-                if vertex[1] == polygon[0][0]:
-                    returns_to_start = True
-                polygon.append(vertex)
-                current_vertex = vertex
-                new_remaining_vertices.remove(vertex)
-                found_next = True
-                break
-        if not found_next or returns_to_start:
-            break
-
-        i += 1
-        if i > 100:
-            break
-    
-    return polygon, new_remaining_vertices
-
-
 def update(frame1, frame2, percentage, first_update=False):
     for i, ball in enumerate(balls):
         trail_items = ball.trail_items
@@ -449,7 +420,7 @@ ball_colors = []
 
 is_paused = False
 
-board_vertices, frames = read_data('data.txt')
+board_vertices, frames = read_data(DATA_PATH)
 num_balls = len(frames[0])
 for i in range(num_balls):
     ball_colors.append(get_ball_color(i, num_balls))
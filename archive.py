@@ -0,0 +1,237 @@
+import argparse
+import lzma
+import os
+import struct
+import zlib
+
+import numpy as np
+
+from trajectory import FIELDS, AsyncWriter, BoardFormat, TrajectoryWriter, read_trajectory
+
+# Archive layout (little endian):
+#   magic    8 bytes    b'BWARCHIV'
+#   header   '<HHIIdd'  version, codec, number of edges, number of balls, position step, velocity step
+#   edges    edges x 4 float64, the board as written by physics.py
+#   chunks   up to the end of the file, each a header then its compressed payload
+#     header   '<QIIdd' first frame, frames, payload bytes, largest position error, largest velocity error
+#     payload  frames x balls x 5 (x, y, vx, vy, r) fixed-point integers, each frame stored as its difference from the
+#              previous frame of the chunk (the first one as is), zigzag encoded to uint64 and split into byte planes
+# Positions (normalized to the board) and radii are stored as multiples of the position step, velocities of the
+# velocity step, so no value is off by more than half a step (the errors recorded per chunk are the exact largest
+# ones). Every chunk decodes on its own: reading a frame range only decompresses the chunks it overlaps.
+MAGIC = b'BWARCHIV'
+VERSION = 1
+HEADER = struct.Struct('<HHIIdd')
+CHUNK = struct.Struct('<QIIdd')
+FORMAT = BoardFormat('trajectory archive', MAGIC, VERSION, HEADER, edges_field=2)
+CODECS = {0: 'zlib', 1: 'lzma'}
+CODEC_CODES = {name: code for code, name in CODECS.items()}
+POSITION_STEP = 2 ** -20  # a millionth of the board, far below a pixel
+VELOCITY_STEP = 2 ** -20
+CHUNK_FRAMES = 256  # most frames per chunk, the unit of random access
+CHUNK_BYTES = 32 * 1024 * 1024  # most raw frame bytes held back for one chunk, bounds the frames per chunk of big runs
+
+
+def field_steps(position_step, velocity_step):
+    return np.array([position_step, position_step, velocity_step, velocity_step, position_step])
+
+
+def quantize(frames, steps):
+    """Fixed-point integers of (frames, balls, 5) records, and the largest position and velocity errors they make"""
+    if not np.all(np.isfinite(frames)):
+        raise ValueError("Only finite frames can be archived")
+    values = np.rint(frames / steps)
+    # Differences of two values then stay below 2 ** 62, which zigzag encodes without overflow
+    if np.max(np.abs(values), initial=0) >= 2 ** 61:
+        raise ValueError("Frame values too large for the archive steps")
+    values = values.astype(np.int64)
+    error = np.abs(values * steps - frames)
+    return values, float(np.max(error[..., [0, 1, 4]], initial=0)), float(np.max(error[..., 2:4], initial=0))
+
+
+def encode_chunk(values, codec):
+    deltas = np.diff(values, axis=0, prepend=np.zeros((1,) + values.shape[1:], np.int64))
+    # Zigzag keeps small negative differences small, so the high byte planes are all zeros and compress to nothing
+    zigzag = ((deltas << 1) ^ (deltas >> 63)).astype('<u8')
+    planes = zigzag.reshape(-1, 1).view(np.uint8).T.tobytes()
+    return zlib.compress(planes) if codec == 'zlib' else lzma.compress(planes)
+
+
+def decode_chunk(payload, frames, num_balls, codec, steps):
+    planes = zlib.decompress(payload) if codec == 'zlib' else lzma.decompress(payload)
+    zigzag = np.frombuffer(planes, np.uint8).reshape(8, -1).T.copy().view('<u8').reshape(frames, num_balls, FIELDS)
+    deltas = (zigzag >> np.uint64(1)).astype(np.int64) ^ -(zigzag & np.uint64(1)).astype(np.int64)
+    return np.cumsum(deltas, axis=0) * steps
+
+
+def read_header(file):
+    (codec, _, num_balls, position_step, velocity_step), edges = FORMAT.read(file)
+    return edges, num_balls, CODECS[codec], position_step, velocity_step
+
+
+def is_archive(path):
+    return FORMAT.matches(path)
+
+
+class ArchiveWriter(TrajectoryWriter):
+    """Quantizes frames and writes them compressed, chunk_frames at a time (None to size chunks from CHUNK_BYTES)
+
+    Frames wait in memory until their chunk is full. mark() and close() write the frames waiting as a shorter chunk,
+    so marks always fall between chunks and a run resumed from one (see checkpoint) carries on with a new chunk. The
+    codec and steps of a resumed archive are the ones in its header."""
+    def __init__(self, path, polygon, num_balls, codec='zlib', chunk_frames=None, position_step=POSITION_STEP,
+                 velocity_step=VELOCITY_STEP, offset=None):
+        if codec not in CODEC_CODES:
+            raise ValueError(f"Unknown archive codec: {codec}")
+        self.codec = codec
+        self.position_step = position_step
+        self.velocity_step = velocity_step
+        self.frames_written = 0
+        if offset is not None:
+            reader = ArchiveReader(path, offset)
+            self.codec = reader.codec
+            self.position_step, self.velocity_step = reader.position_step, reader.velocity_step
+            self.frames_written = len(reader)
+        self.steps = field_steps(self.position_step, self.velocity_step)
+        if chunk_frames is None:
+            chunk_frames = min(CHUNK_FRAMES, max(1, CHUNK_BYTES // max(1, num_balls * FIELDS * 8)))
+        self.chunk_frames = chunk_frames
+        self.pending = []
+        self.pending_frames = 0
+        super().__init__(path, polygon, num_balls, np.float64, offset)
+
+    def open(self, path):
+        file = open(path, 'wb')
+        self.bytes_written = FORMAT.write(file, self.polygon, CODEC_CODES[self.codec], self.polygon.shape[0],
+                                          self.num_balls, self.position_step, self.velocity_step)
+        return file
+
+    def write_frames(self, frames):
+        frames = np.asarray(frames, np.float64).reshape(-1, self.num_balls, FIELDS)
+        self.pending.append(frames)
+        self.pending_frames += frames.shape[0]
+        if self.pending_frames >= self.chunk_frames:
+            self.write_pending(whole=True)
+
+    def write_pending(self, whole=False):
+        """Write the frames waiting as chunks, keeping back the ones short of a whole chunk when whole is set"""
+        if not self.pending:
+            return
+        frames = np.concatenate(self.pending)
+        stop = frames.shape[0] // self.chunk_frames * self.chunk_frames if whole else frames.shape[0]
+        for start in range(0, stop, self.chunk_frames):
+            self.write_chunk(frames[start:min(start + self.chunk_frames, stop)])
+        self.pending = [frames[stop:]] if stop < frames.shape[0] else []
+        self.pending_frames = frames.shape[0] - stop
+
+    def write_chunk(self, frames):
+        values, position_error, velocity_error = quantize(frames, self.steps)
+        payload = encode_chunk(values, self.codec)
+        self.bytes_written += self.file.write(CHUNK.pack(self.frames_written, frames.shape[0], len(payload),
+                                                         position_error, velocity_error))
+        self.bytes_written += self.file.write(payload)
+        self.frames_written += frames.shape[0]
+
+    def mark(self):
+        self.write_pending()
+        return super().mark()
+
+    def close(self):
+        if not self.file.closed:
+            self.write_pending()
+        super().close()
+
+
+def open_archive(path, polygon, num_balls, background=False, offset=None, **options):
+    """ArchiveWriter (options go to it), behind a writer thread when background is set, like open_writer"""
+    writer = ArchiveWriter(path, polygon, num_balls, offset=offset, **options)
+    return AsyncWriter(writer) if background else writer
+
+
+class ArchiveReader:
+    """Frames of an archive, only the chunks a frame range overlaps are read and decompressed
+
+    Opening scans the chunk headers, seeking over the payloads. A chunk cut short by a killed run, and anything past
+    end (a byte offset), is left out."""
+    def __init__(self, path, end=None):
+        self.path = path
+        with open(path, 'rb') as file:
+            self.edges, self.num_balls, self.codec, self.position_step, self.velocity_step = read_header(file)
+            start = file.tell()
+            end = file.seek(0, 2) if end is None else end
+            file.seek(start)
+            chunks = []
+            while file.tell() + CHUNK.size <= end:
+                first, frames, size, position_error, velocity_error = CHUNK.unpack(file.read(CHUNK.size))
+                if file.tell() + size > end:
+                    break
+                chunks.append((first, frames, file.tell(), size, position_error, velocity_error))
+                file.seek(size, 1)
+        chunks = np.array(chunks, np.float64).reshape(-1, 6)
+        self.first = chunks[:, 0].astype(np.int64)
+        self.frames = chunks[:, 1].astype(np.int64)
+        self.offsets = chunks[:, 2].astype(np.int64)
+        self.sizes = chunks[:, 3].astype(np.int64)
+        self.position_errors = chunks[:, 4]
+        self.velocity_errors = chunks[:, 5]
+        self.steps = field_steps(self.position_step, self.velocity_step)
+
+    def __len__(self):
+        return int(self.first[-1] + self.frames[-1]) if self.first.shape[0] else 0
+
+    def chunks(self, start, stop):
+        """Indices of the chunks holding frames [start, stop)"""
+        return range(np.searchsorted(self.first + self.frames, start, 'right'), np.searchsorted(self.first, stop))
+
+    def read_frames(self, start=0, stop=None):
+        """(frames, balls, 5) float64 records of frames [start, stop)"""
+        stop = len(self) if stop is None else min(stop, len(self))
+        frames = np.empty((max(stop - start, 0), self.num_balls, FIELDS))
+        with open(self.path, 'rb') as file:
+            for k in self.chunks(start, stop):
+                file.seek(self.offsets[k])
+                chunk = decode_chunk(file.read(self.sizes[k]), self.frames[k], self.num_balls, self.codec, self.steps)
+                lo, hi = max(start, self.first[k]), min(stop, self.first[k] + self.frames[k])
+                frames[lo - start:hi - start] = chunk[lo - self.first[k]:hi - self.first[k]]
+        return frames
+
+    def error_bound(self, start=0, stop=None):
+        """Largest (position, velocity) error of any value in frames [start, stop)"""
+        chunks = list(self.chunks(start, len(self) if stop is None else stop))
+        return (float(np.max(self.position_errors[chunks], initial=0)),
+                float(np.max(self.velocity_errors[chunks], initial=0)))
+
+
+def read_archive(path, start=0, stop=None):
+    """Board edges (edges, 4) and frames (frames, balls, 5) of an archive, like read_trajectory"""
+    reader = ArchiveReader(path)
+    return reader.edges, reader.read_frames(start, stop)
+
+
+def archive_trajectory(trajectory_path, archive_path, **options):
+    """Archive a binary trajectory, options go to ArchiveWriter (codec, chunk_frames and the steps)"""
+    edges, frames = read_trajectory(trajectory_path, mmap=True)
+    writer = ArchiveWriter(archive_path, edges, frames.shape[1], **options)
+    for start in range(0, frames.shape[0], writer.chunk_frames):
+        writer.write_frames(frames[start:start + writer.chunk_frames])
+    writer.close()
+    return writer
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archive a binary trajectory as quantized, compressed chunks")
+    parser.add_argument('trajectory')
+    parser.add_argument('archive')
+    parser.add_argument('--codec', choices=sorted(CODEC_CODES), default='zlib')
+    parser.add_argument('--position-step', type=float, default=POSITION_STEP)
+    parser.add_argument('--velocity-step', type=float, default=VELOCITY_STEP)
+    args = parser.parse_args()
+
+    archive_trajectory(args.trajectory, args.archive, codec=args.codec, position_step=args.position_step,
+                       velocity_step=args.velocity_step)
+    reader = ArchiveReader(args.archive)
+    position_error, velocity_error = reader.error_bound()
+    size, archived = os.path.getsize(args.trajectory), os.path.getsize(args.archive)
+    print(f"{len(reader)} frames in {reader.first.shape[0]} chunks, {size} -> {archived} bytes "
+          f"({size / max(archived, 1):.1f}x), largest errors {position_error:.3g} (positions) and "
+          f"{velocity_error:.3g} (velocities)")
@@ -0,0 +1,187 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from physics import Simulation
+from random_setup import random_board
+from trajectory import open_writer
+
+BALL_COUNTS = (10, 100, 1000, 10000, 100000)
+QUICK_BALL_COUNTS = (10, 100, 1000)
+RADIUS_SCALE = 0.5  # radius = RADIUS_SCALE / sqrt(balls): 1/20 at 100 balls, the same crowding at every size
+CHUNK_SIZE = 4096  # keeps the dense kernel's work matrices bounded at 100k balls
+MIN_SECONDS = 0.5
+MIN_FRAMES = 3
+REPEATS = 5  # timings of a case, the fastest is kept: noise from the rest of the machine only ever slows a run down
+TOLERANCE = 0.2  # slowdown (as a fraction of the baseline) reported as a regression
+SCALING_BALLS = (100000, 1000000)
+
+
+def regular_polygon(sides, radius=0.5, center=(0.5, 0.5)):
+    """Counter-clockwise edges of a regular polygon"""
+    angles = 2 * np.pi * np.arange(sides) / sides
+    points = np.column_stack((center[0] + radius * np.cos(angles), center[1] + radius * np.sin(angles)))
+    return np.column_stack((points, np.roll(points, -1, axis=0)))
+
+
+def star_polygon(spikes, outer=0.5, inner=0.3, center=(0.5, 0.5)):
+    """Counter-clockwise edges of a star with 2 * spikes sides, concave like the creator boards"""
+    angles = np.pi * np.arange(2 * spikes) / spikes
+    radii = np.where(np.arange(2 * spikes) % 2 == 0, outer, inner)
+    points = np.column_stack((center[0] + radii * np.cos(angles), center[1] + radii * np.sin(angles)))
+    return np.column_stack((points, np.roll(points, -1, axis=0)))
+
+
+def benchmark_boards():
+    # From 4 sides up to the size of the boards drawn in the polygon creator
+    return {'square': np.array(random_board(), np.float64).reshape(-1, 4),
+            'regular-16': regular_polygon(16),
+            'star-64': star_polygon(32),
+            'star-300': star_polygon(150)}
+
+
+def case_key(case):
+    return (case['board'], case['balls'], case['collisions'], case['output'], case.get('edge_index', False),
+            case.get('workers', 1))
+
+
+def time_case(polygon, balls, collisions, output, edge_index, min_seconds, seed, workers):
+    """Frames stepped and seconds taken by one fresh simulation, stepping until min_seconds have passed"""
+    with tempfile.TemporaryDirectory() as directory:
+        simulation = Simulation(polygon, balls, radius=RADIUS_SCALE / np.sqrt(balls), collisions=collisions,
+                                swept=False, event_driven=False, edge_index=edge_index, chunk_size=CHUNK_SIZE,
+                                workers=workers, rng=seed)
+        if output:
+            simulation.add_sink(open_writer(os.path.join(directory, 'benchmark.traj'), polygon, balls,
+                                            background=True))
+        with simulation:
+            # Warm up the scratch buffers and the writer thread
+            simulation.step(1)
+            frames = 0
+            batch = 1
+            start = time.perf_counter()
+            while True:
+                simulation.step(batch)
+                frames += batch
+                seconds = time.perf_counter() - start
+                if seconds >= min_seconds and frames >= MIN_FRAMES:
+                    break
+                batch = min(batch * 2, 256)
+            # Queued frames count towards the time when output is on
+            simulation.close()
+            seconds = time.perf_counter() - start
+    return frames, seconds
+
+
+def run_case(board, polygon, balls, collisions, output, edge_index=False, min_seconds=MIN_SECONDS, seed=0,
+             workers=1, repeats=REPEATS):
+    """Frames per second of Simulation.step for one configuration, the best of repeats timings"""
+    samples = [time_case(polygon, balls, collisions, output, edge_index, min_seconds, seed, workers)
+               for _ in range(repeats)]
+    frames, seconds = max(samples, key=lambda sample: sample[0] / sample[1])
+    return {'board': board, 'edges': int(polygon.shape[0]), 'balls': balls, 'collisions': collisions,
+            'output': output, 'edge_index': edge_index, 'workers': workers, 'frames': frames, 'seconds': seconds,
+            'fps': frames / seconds, 'ball_fps': frames * balls / seconds,
+            'samples': [frames / seconds for frames, seconds in samples]}
+
+
+def run_suite(ball_counts=BALL_COUNTS, boards=None, edge_index=False, min_seconds=MIN_SECONDS, repeats=REPEATS,
+              progress=print):
+    boards = benchmark_boards() if boards is None else boards
+    results = []
+    for board, polygon in boards.items():
+        for balls in ball_counts:
+            for collisions in (False, True):
+                for output in (False, True):
+                    result = run_case(board, polygon, balls, collisions, output, edge_index, min_seconds,
+                                      repeats=repeats)
+                    results.append(result)
+                    if progress is not None:
+                        progress(f"{board:>10} {balls:>6} balls  collisions={collisions!s:<5}  output={output!s:<5}"
+                                 f"  {result['fps']:10.1f} frames/s  {result['ball_fps']:12.0f} ball-frames/s")
+    return {'machine': {'python': platform.python_version(), 'numpy': np.__version__,
+                        'platform': platform.platform(), 'processor': platform.processor(),
+                        'cpus': os.cpu_count()},
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}
+
+
+def run_scaling(ball_counts=SCALING_BALLS, worker_counts=None, board='star-64', min_seconds=MIN_SECONDS,
+                repeats=REPEATS, progress=print):
+    """Strong scaling of the parallel stepper: the same simulation on 1, 2, 4... workers, without output"""
+    polygon = benchmark_boards()[board]
+    if worker_counts is None:
+        worker_counts = [1 << k for k in range(int(np.log2(os.cpu_count() or 1)) + 1)]
+    results = []
+    for balls in ball_counts:
+        for collisions in (False, True):
+            serial = None
+            for workers in worker_counts:
+                result = run_case(board, polygon, balls, collisions, False, min_seconds=min_seconds, workers=workers,
+                                  repeats=repeats)
+                serial = serial or result['fps']
+                result['speedup'] = result['fps'] / serial
+                result['efficiency'] = result['speedup'] / workers
+                results.append(result)
+                if progress is not None:
+                    progress(f"{balls:>8} balls  collisions={collisions!s:<5}  {workers:>3} workers"
+                             f"  {result['fps']:8.2f} frames/s  speedup {result['speedup']:5.2f}"
+                             f"  efficiency {result['efficiency']:6.1%}")
+    return {'machine': {'python': platform.python_version(), 'numpy': np.__version__,
+                        'platform': platform.platform(), 'processor': platform.processor(),
+                        'cpus': os.cpu_count()},
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}
+
+
+def compare(report, baseline, tolerance=TOLERANCE):
+    """(result, baseline result, speed ratio) of every case that got slower than the baseline by more than tolerance
+
+    Both sides are compared by their best timing (see run_case), a single slow sample is not a regression."""
+    previous = {case_key(case): case for case in baseline['results']}
+    regressions = []
+    for result in report['results']:
+        reference = previous.get(case_key(result))
+        if reference is None:
+            continue
+        ratio = result['ball_fps'] / reference['ball_fps']
+        if ratio < 1 - tolerance:
+            regressions.append((result, reference, ratio))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time Simulation.step across ball counts, boards, collisions and output")
+    parser.add_argument('--quick', action='store_true', help="only up to 1000 balls, shorter timings")
+    parser.add_argument('--edge-index', action='store_true', help="use the bucketed edge index instead of the dense kernel")
+    parser.add_argument('--output', default='benchmark.json', help="where to write the results")
+    parser.add_argument('--baseline', help="results to compare against, exits with 1 on regressions")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--repeats', type=int, default=REPEATS, help="timings of every case, the fastest is kept")
+    parser.add_argument('--scaling', action='store_true', help="strong scaling of the parallel stepper instead")
+    parser.add_argument('--workers', type=int, nargs='+', help="worker counts for --scaling, powers of two up to "
+                                                                 "the number of CPUs by default")
+    args = parser.parse_args()
+
+    if args.scaling:
+        report = run_scaling(SCALING_BALLS[:1] if args.quick else SCALING_BALLS, args.workers,
+                             repeats=args.repeats)
+    else:
+        report = run_suite(QUICK_BALL_COUNTS if args.quick else BALL_COUNTS, edge_index=args.edge_index,
+                           min_seconds=MIN_SECONDS / 5 if args.quick else MIN_SECONDS, repeats=args.repeats)
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(report, json.load(file), args.tolerance)
+        for result, reference, ratio in regressions:
+            print(f"REGRESSION {result['board']} {result['balls']} balls collisions={result['collisions']} "
+                  f"output={result['output']}: {reference['ball_fps']:.0f} -> {result['ball_fps']:.0f} "
+                  f"ball-frames/s ({ratio:.2f}x)")
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,205 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from edge_index import EdgeIndex
+from kernels import EdgeKernel, edge_geometry
+from sdf import DistanceField
+from trajectory import board_bounds
+from triangulation import TriangleMesh
+
+CACHE_DIR = 'board_cache'
+CACHE_VERSION = 3  # bump whenever compile_board changes what it stores
+MAX_CACHE_BYTES = 256 * 1024 * 1024
+FIELD_ARRAYS = ('grid', 'shape', 'field', 'cells', 'vertex_ys')
+MESH_ARRAYS = ('mesh_triangles', 'mesh_neighbours', 'mesh_start', 'mesh_grid', 'mesh_shape', 'mesh_vertex_ys')
+
+
+def board_key(polygon):
+    """Hash of the edge list, the name of the board's entry in the cache"""
+    polygon = np.ascontiguousarray(polygon, '<f8')
+    digest = hashlib.sha256(f"{CACHE_VERSION} {polygon.shape}".encode())
+    digest.update(polygon.tobytes())
+    return digest.hexdigest()[:32]
+
+
+def edge_loops(polygon):
+    """Edges chained end to start into outlines, as CSR (offsets, edges)"""
+    starts = {}
+    for e, start in enumerate(map(tuple, polygon[:, 0:2].tolist())):
+        starts.setdefault(start, []).append(e)
+    used = np.zeros(polygon.shape[0], bool)
+    loops = []
+    for first in range(polygon.shape[0]):
+        e = first
+        loop = []
+        while e is not None and not used[e]:
+            used[e] = True
+            loop.append(e)
+            e = next((f for f in starts.get(tuple(polygon[e, 2:4].tolist()), ()) if not used[f]), None)
+        if loop:
+            loops.append(loop)
+    offsets = np.zeros(len(loops) + 1, np.int64)
+    offsets[1:] = np.cumsum([len(loop) for loop in loops])
+    return offsets, np.array([e for loop in loops for e in loop], np.int64)
+
+
+def compile_board(polygon, resolution=None):
+    """Every array derived from the edge list: line coefficients, normals, bounds, edge index and outlines"""
+    polygon = np.asarray(polygon, np.float64)
+    As, Bs, Cs, normals, lower, upper = edge_geometry(polygon)
+    bounds, size = board_bounds(polygon)
+    index = EdgeIndex(polygon, As, Bs, Cs, lower, upper, resolution)
+    loop_offsets, loop_edges = edge_loops(polygon)
+    return {'polygon': polygon, 'As': As, 'Bs': Bs, 'Cs': Cs, 'normals': normals, 'lower': lower, 'upper': upper,
+            'bounds': np.array(bounds), 'size': np.array(size), 'loop_offsets': loop_offsets,
+            'loop_edges': loop_edges, **index.arrays()}
+
+
+class CompiledBoard:
+    """Board geometry read back from the cache, every array is a read-only memory map"""
+    def __init__(self, arrays, key=None, path=None):
+        self.arrays = arrays
+        self.key = key
+        self.path = path
+        for name, value in arrays.items():
+            setattr(self, name, value)
+        self.bounds = tuple(arrays['bounds'].tolist())
+        self.size = tuple(arrays['size'].tolist())
+
+    def geometry(self):
+        """Same tuple as kernels.edge_geometry"""
+        return self.As, self.Bs, self.Cs, self.normals, self.lower, self.upper
+
+    def edge_kernel(self, chunk_size=None, dtype=np.float64):
+        return EdgeKernel(self.As, self.Bs, self.Cs, self.lower, self.upper, chunk_size=chunk_size, dtype=dtype)
+
+    def edge_index(self, chunk_size=None, dtype=np.float64):
+        return EdgeIndex.from_arrays(self.edge_kernel(chunk_size, dtype), self.arrays)
+
+    def distance_field(self, resolution=None, chunk_size=None, dtype=np.float64):
+        """Distance field of the board at this resolution, rasterized the first time and then kept in the cache"""
+        prefix = f"field_{resolution or 'default'}_"
+        arrays = {name[len(prefix):]: value for name, value in self.arrays.items() if name.startswith(prefix)}
+        if set(arrays) == set(FIELD_ARRAYS):
+            return DistanceField.from_arrays(self.edge_index(chunk_size, dtype), arrays)
+        field = DistanceField(self.polygon, self.As, self.Bs, self.Cs, self.lower, self.upper, resolution, chunk_size,
+                              dtype)
+        arrays = {prefix + name: value for name, value in field.arrays().items()}
+        self.arrays.update(arrays)
+        if self.path is not None:
+            add(self.path, arrays)
+        return field
+
+    def triangle_mesh(self, chunk_size=None, dtype=np.float64):
+        """Triangulation of the board, built the first time and then kept in the cache"""
+        arrays = {name: value for name, value in self.arrays.items() if name.startswith('mesh_')}
+        if set(arrays) == set(MESH_ARRAYS):
+            return TriangleMesh.from_arrays(self.edge_index(chunk_size, dtype), arrays)
+        mesh = TriangleMesh(self.polygon, self.As, self.Bs, self.Cs, self.lower, self.upper, chunk_size=chunk_size,
+                            dtype=dtype)
+        arrays = mesh.arrays()
+        self.arrays.update(arrays)
+        if self.path is not None:
+            add(self.path, arrays)
+        return mesh
+
+    def loops(self):
+        """Vertices of every outline, each edge contributing its start point"""
+        return [self.polygon[self.loop_edges[a:b], 0:2] for a, b in zip(self.loop_offsets[:-1], self.loop_offsets[1:])]
+
+
+def make_edge_kernel(polygon, As, Bs, Cs, lower, upper, board=None, triangulated=False, distance_field=False,
+                     field_resolution=None, edge_index=False, chunk_size=None, dtype=np.float64):
+    """Containment test of the board: its triangulation, distance field or edge index when asked for (the first one
+    set wins), the dense EdgeKernel otherwise. The prepared ones come from board, a CompiledBoard, when given.
+    chunk_size and dtype go to whichever EdgeKernel ends up doing the dense work."""
+    if triangulated and board is not None:
+        return board.triangle_mesh(chunk_size, dtype)
+    if triangulated:
+        return TriangleMesh(polygon, As, Bs, Cs, lower, upper, chunk_size=chunk_size, dtype=dtype)
+    if distance_field and board is not None:
+        return board.distance_field(field_resolution, chunk_size, dtype)
+    if distance_field:
+        return DistanceField(polygon, As, Bs, Cs, lower, upper, field_resolution, chunk_size, dtype)
+    if edge_index and board is not None:
+        return board.edge_index(chunk_size, dtype)
+    if edge_index:
+        return EdgeIndex(polygon, As, Bs, Cs, lower, upper, chunk_size=chunk_size, dtype=dtype)
+    return EdgeKernel(As, Bs, Cs, lower, upper, chunk_size=chunk_size, dtype=dtype)
+
+
+def store(path, arrays):
+    # Written next to the cache entry then renamed into place, so readers never see half a board
+    directory = tempfile.mkdtemp(prefix='.tmp-', dir=os.path.dirname(path))
+    try:
+        for name, value in arrays.items():
+            np.save(os.path.join(directory, f"{name}.npy"), value)
+        os.rename(directory, path)
+    except OSError:
+        # Another process stored the same board first
+        shutil.rmtree(directory, ignore_errors=True)
+        if not os.path.isdir(path):
+            raise
+
+
+def add(path, arrays):
+    """Save more arrays into an existing entry, one atomic rename per file"""
+    for name, value in arrays.items():
+        temporary = os.path.join(path, f".{name}.{os.getpid()}.tmp")
+        try:
+            with open(temporary, 'wb') as file:
+                np.save(file, value)
+            os.replace(temporary, os.path.join(path, f"{name}.npy"))
+        except OSError:
+            # The entry was evicted meanwhile, the arrays are simply not kept
+            return
+
+
+def load(path):
+    return {name[:-4]: np.asarray(np.load(os.path.join(path, name), mmap_mode='r'))
+            for name in os.listdir(path) if name.endswith('.npy')}
+
+
+def evict(cache_dir, max_bytes, keep=None):
+    """Remove the least recently used boards until the cache fits in max_bytes"""
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.startswith('.') or not os.path.isdir(path):
+            continue
+        try:
+            size = sum(os.path.getsize(os.path.join(path, file)) for file in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, name))
+        except OSError:
+            continue
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        if name != keep:
+            shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+            total -= size
+
+
+def compiled_board(polygon, cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+    """The compiled board of this edge list, built and stored in cache_dir the first time it is asked for"""
+    polygon = np.asarray(polygon, np.float64)
+    key = board_key(polygon)
+    path = os.path.join(cache_dir, key)
+    os.makedirs(cache_dir, exist_ok=True)
+    for _ in range(2):
+        if not os.path.isdir(path):
+            store(path, compile_board(polygon))
+            evict(cache_dir, max_bytes, keep=key)
+        try:
+            # The modification time orders the entries for eviction
+            os.utime(path)
+            return CompiledBoard(load(path), key, path)
+        except FileNotFoundError:
+            # Evicted by another process in between, build it again
+            continue
+    return CompiledBoard(compile_board(polygon), key)
@@ -0,0 +1,77 @@
+import json
+import os
+import queue
+import threading
+
+import numpy as np
+
+# A checkpoint is an .npz of the Simulation state at the end of a frame: x, v and radii, the frame index, the bounce
+# and contact counters, the generator state (as JSON), the board hash and dt it belongs to, and the byte offset every
+# sink had reached at that frame, in the order the sinks were added (trajectory, event log, metrics). Adaptive runs
+# also keep their clock, the path of the last step and the wall hits not written yet, runs with rest detection the
+# indices of the balls still moving.
+VERSION = 1
+
+
+def save_checkpoint(path, snapshot):
+    """Write a Simulation.snapshot() once its sinks have flushed up to it
+
+    Written next to path then renamed over it, so a run killed mid-save still has the previous checkpoint."""
+    snapshot = dict(snapshot)
+    offsets = [mark.wait() for mark in snapshot.pop('marks')]
+    rng = json.dumps(snapshot.pop('rng'))
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, 'wb') as file:
+        np.savez(file, version=VERSION, offsets=np.array(offsets, np.int64), rng=rng, **snapshot)
+    os.replace(temporary, path)
+
+
+def load_checkpoint(path):
+    with np.load(path) as data:
+        checkpoint = {name: data[name] for name in data.files}
+    if checkpoint['version'] > VERSION:
+        raise ValueError(f"Checkpoint version {checkpoint['version']} is newer than this reader ({VERSION})")
+    checkpoint['rng'] = json.loads(str(checkpoint['rng']))
+    for name in ('frame', 'wall_count', 'collision_count', 'dt', 'board', 'clock', 'segment_time'):
+        if name in checkpoint:
+            checkpoint[name] = checkpoint[name].item()
+    return checkpoint
+
+
+class Checkpointer:
+    """Saves snapshots to path from a background thread, the step loop only pays for copying the state
+
+    Each save waits for the sinks to flush up to its frame, so a checkpoint never points past the data on disk. At
+    most max_pending snapshots wait, after which save blocks."""
+    def __init__(self, path, interval, max_pending=2):
+        self.path = path
+        self.interval = interval
+        self.pending = queue.Queue(max_pending)
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.drain, name='checkpoint-writer', daemon=True)
+        self.thread.start()
+
+    def save(self, snapshot):
+        if self.error is not None:
+            raise self.error
+        self.pending.put(snapshot)
+
+    def drain(self):
+        while True:
+            snapshot = self.pending.get()
+            if snapshot is None:
+                return
+            try:
+                save_checkpoint(self.path, snapshot)
+            except BaseException as error:
+                self.error = error
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.pending.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
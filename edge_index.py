@@ -0,0 +1,89 @@
+import numpy as np
+
+from kernels import EdgeKernel, expand_ranges
+
+
+def bucket(memberships, buckets):
+    """CSR layout (offsets, items) of the items listed under each bucket, items kept in increasing order"""
+    lists = [[] for _ in range(buckets)]
+    for item, members in enumerate(memberships):
+        for k in members:
+            lists[k].append(item)
+    offsets = np.zeros(buckets + 1, np.int64)
+    offsets[1:] = np.cumsum([len(l) for l in lists])
+    items = np.array([item for l in lists for item in l], np.int64)
+    return offsets, items
+
+
+class EdgeIndex:
+    """Horizontal slabs of edge buckets over the board, a drop-in replacement for EdgeKernel on detailed boards
+
+    Only the crossing count needs the buckets. The nearest side is the first maximum of A x + B y + C over every edge,
+    which a far edge can win, so it comes from the full kernel, for the few balls that left the table. chunk_size and
+    dtype are those of that kernel."""
+    def __init__(self, polygon, As, Bs, Cs, lower, upper, resolution=None, chunk_size=None, dtype=np.float64):
+        self.kernel = EdgeKernel(As, Bs, Cs, lower, upper, chunk_size=chunk_size, dtype=dtype)
+        edges = polygon.shape[0]
+        if resolution is None:
+            resolution = max(4, int(np.ceil(4 * np.sqrt(edges))))
+
+        width = np.max(polygon[:, ::2]) - np.min(polygon[:, ::2])
+        self.y0, self.y1 = np.min(polygon[:, 1::2]), np.max(polygon[:, 1::2])
+        self.cell_size = max(width, self.y1 - self.y0) / resolution
+        self.ny = max(1, int(np.ceil((self.y1 - self.y0) / self.cell_size)))
+
+        # Horizontal slabs hold the edges whose y range overlaps them: the only ones a ray from inside can cross
+        iy_lower = self.row(np.asarray(lower))
+        iy_upper = self.row(np.asarray(upper))
+        straddling = np.asarray(As) != 0
+        self.slab_offsets, self.slab_edges = bucket(
+            [range(a, b + 1) if keep else () for a, b, keep in zip(iy_lower, iy_upper, straddling)], self.ny)
+
+    def arrays(self):
+        """Everything the index needs at run time, as arrays that can be saved and handed back to from_arrays"""
+        return {'index_grid': np.array([self.y0, self.y1, self.cell_size]),
+                'index_shape': np.array([self.ny], np.int64),
+                'slab_offsets': self.slab_offsets, 'slab_edges': self.slab_edges}
+
+    @classmethod
+    def from_arrays(cls, kernel, arrays):
+        """Rebuild an index around the given EdgeKernel without bucketing the edges again"""
+        index = cls.__new__(cls)
+        index.kernel = kernel
+        index.y0, index.y1, index.cell_size = arrays['index_grid'].tolist()
+        index.ny, = arrays['index_shape'].tolist()
+        for name in ('slab_offsets', 'slab_edges'):
+            setattr(index, name, arrays[name])
+        return index
+
+    def row(self, py):
+        return np.clip(np.floor((py - self.y0) / self.cell_size).astype(np.int64), 0, self.ny - 1)
+
+    def __call__(self, x, num_intersections=None, nearest_side=None):
+        n = x.shape[0]
+        if num_intersections is None:
+            num_intersections = np.zeros(n, np.int32)
+        if nearest_side is None:
+            nearest_side = np.zeros(n, np.int32)
+        kernel = self.kernel
+        px = x[:, 0]
+        py = x[:, 1]
+
+        # Ray-crossing parity against the edges of each ball's slab, same test as the full kernel
+        slab = self.row(py)
+        start = self.slab_offsets[slab]
+        count = self.slab_offsets[slab + 1] - start
+        count[(py < self.y0) | (py > self.y1)] = 0
+        owner, position = expand_ranges(start, count)
+        e = self.slab_edges[position]
+        x_isect = (kernel.Cs[e] + kernel.Bs[e] * py[owner]) / kernel.neg_As[e]
+        crossed = (kernel.lower[e] < py[owner]) & (py[owner] < kernel.upper[e]) & (x_isect < px[owner])
+        num_intersections[:] = np.bincount(owner, crossed, n)
+
+        # Only balls that left the table need a side to bounce off
+        nearest_side[:] = 0
+        outside = np.flatnonzero(num_intersections % 2 == 0)
+        if outside.shape[0] > 0:
+            _, side = kernel(x[outside])
+            nearest_side[outside] = side
+        return num_intersections, nearest_side
@@ -0,0 +1,82 @@
+import numpy as np
+
+from board_cache import compiled_board, make_edge_kernel
+from broadphase import CollisionGrid
+from kernels import edge_geometry, reflect_walls
+from swept import SweptWalls
+from trajectory import board_bounds, open_writer
+
+
+def initial_state(polygon, runs, num_balls, epsilon=-0.2, max_v=1, rng=None):
+    """Random positions in the (shrunk by epsilon) bounding box of the board and normal velocities, per run"""
+    rng = np.random.default_rng(rng)
+    bounds, size = board_bounds(polygon)
+    x = np.empty((runs, num_balls, 2))
+    x[..., 0] = rng.uniform(bounds[0] - size[0] * epsilon, bounds[1] + size[0] * epsilon, (runs, num_balls))
+    x[..., 1] = rng.uniform(bounds[2] - size[1] * epsilon, bounds[3] + size[1] * epsilon, (runs, num_balls))
+    v = rng.standard_normal((runs, num_balls, 2)) * max_v
+    return x, v
+
+
+def run_ensemble(polygon, runs, num_balls=100, frames=1200, dt=0.0025, mu=1, epsilon=-0.2, max_v=1, radius=1/20,
+                 collisions=False, swept=False, edge_index=False, distance_field=False, triangulated=False, seed=None,
+                 output=None, output_format='binary', board_cache=None, chunk_size=None):
+    """Simulate many independent runs on the same board at once, with state arrays of shape (runs, balls, 2)
+
+    Every run goes through the same edge tests as one flat batch of runs * balls. output is either None, a path
+    containing '{run}' for one trajectory per run, or a single path where the runs are stacked side by side
+    (runs * balls balls per frame, run after run). board_cache is the directory of compiled boards to load the
+    geometry from, None to derive it here. chunk_size bounds the balls per pass of the edge kernel and the swept
+    wall test, like in Simulation."""
+    polygon = np.asarray(polygon, np.float64)
+    board = compiled_board(polygon, board_cache) if board_cache is not None else None
+    As, Bs, Cs, normals, lower, upper = board.geometry() if board is not None else edge_geometry(polygon)
+    x, v = initial_state(polygon, runs, num_balls, epsilon, max_v, seed)
+    radii = np.full(num_balls, radius)
+
+    # Flat views over every ball of every run
+    flat_x = x.reshape(-1, 2)
+    flat_v = v.reshape(-1, 2)
+    run_of = np.repeat(np.arange(runs), num_balls)
+    flat_radii = np.tile(radii, runs)
+    edge_kernel = make_edge_kernel(polygon, As, Bs, Cs, lower, upper, board, triangulated, distance_field,
+                                   edge_index=edge_index, chunk_size=chunk_size)
+    swept_walls = SweptWalls(polygon, normals, chunk_size=chunk_size)
+    collision_grid = CollisionGrid(flat_radii)
+    num_intersections = np.zeros(runs * num_balls, np.int32)
+    nearest_side = np.zeros(runs * num_balls, np.int32)
+
+    writers = []
+    if output is not None and '{run}' in output:
+        writers = [open_writer(output.format(run=run), polygon, num_balls, output_format) for run in range(runs)]
+    elif output is not None:
+        writers = [open_writer(output, polygon, runs * num_balls, output_format, background=True)]
+
+    wall_bounces = np.zeros(runs, np.int64)
+    contacts = np.zeros(runs, np.int64)
+    try:
+        for n in range(frames):
+            if swept:
+                bounced, _, _ = swept_walls.advance(flat_x, flat_v, dt)
+                flat_v *= mu
+            else:
+                flat_x += flat_v * dt
+                flat_v *= mu
+                edge_kernel(flat_x, num_intersections, nearest_side)
+                bounced = reflect_walls(flat_v, num_intersections, nearest_side, normals)
+            wall_bounces += np.bincount(run_of[bounced], minlength=runs)
+            if collisions:
+                i, _ = collision_grid.resolve(flat_x, flat_v, run_of)
+                contacts += np.bincount(run_of[i], minlength=runs)
+
+            if len(writers) == 1:
+                writers[0].write_frame(flat_x, flat_v, flat_radii)
+            elif writers:
+                records = writers[0].records(x, v, radii)
+                for run, writer in enumerate(writers):
+                    writer.write_frames(records[run:run + 1])
+    finally:
+        for writer in writers:
+            writer.close()
+
+    return {'x': x, 'v': v, 'wall_bounces': wall_bounces, 'contacts': contacts}
@@ -0,0 +1,108 @@
+import struct
+import sys
+
+import numpy as np
+
+from events import CONTACT, START, WALL
+from trajectory import BoardFormat, OutputFile, open_writer, read_records
+
+# Event log layout (little endian):
+#   magic    8 bytes  b'BWEVENT\0'
+#   header   '<HIId'  version, number of edges, number of balls, frame time step
+#   edges    edges x 4 float64, the board as written by physics.py
+#   radii    balls float64
+#   events   EVENT_DTYPE records up to the end of the file, in the order they happened
+# Between two events of a ball its motion is a straight line, so its state in frame k (at time k * dt) is the position
+# and velocity of its last event processed up to that frame, extrapolated linearly. Events keep the frame they belong
+# to because a bounce at the very start of frame k + 1 has the same time as the end of frame k.
+MAGIC = b'BWEVENT\0'
+VERSION = 1
+HEADER = struct.Struct('<HIId')
+FORMAT = BoardFormat('event log', MAGIC, VERSION, HEADER, edges_field=1)
+EVENT_DTYPE = np.dtype([('ball', '<i4'), ('kind', '<i4'), ('other', '<i4'), ('frame', '<i4'), ('time', '<f8'),
+                        ('x', '<f8'), ('y', '<f8'), ('vx', '<f8'), ('vy', '<f8')])
+KINDS = {WALL: 'wall', CONTACT: 'contact', START: 'start'}
+
+
+class EventLogWriter(OutputFile):
+    """Writes one record per ball per velocity change: walls (other is the edge), contacts (other is the partner)
+    and the starting state of every ball (other is -1)
+
+    A wall record with other -1 marks a ball the swept stepper held at a wall until the end of the frame."""
+    def __init__(self, path, polygon, radii, dt, offset=None):
+        self.polygon = np.asarray(polygon, np.float64)
+        self.radii = np.asarray(radii, np.float64)
+        self.dt = dt
+        self.start(path, offset)
+
+    def open(self, path):
+        file = open(path, 'wb')
+        FORMAT.write(file, self.polygon, self.polygon.shape[0], self.radii.shape[0], self.dt)
+        file.write(self.radii.astype('<f8').tobytes())
+        self.bytes_written = file.tell()
+        return file
+
+    def write_events(self, balls, frames, times, kinds, others, x, v):
+        """Append records, scalars are repeated for every ball"""
+        balls = np.asarray(balls)
+        records = np.empty(balls.shape[0], EVENT_DTYPE)
+        records['ball'] = balls
+        records['kind'] = kinds
+        records['other'] = others
+        records['frame'] = frames
+        records['time'] = times
+        records['x'] = x[:, 0]
+        records['y'] = x[:, 1]
+        records['vx'] = v[:, 0]
+        records['vy'] = v[:, 1]
+        self.bytes_written += self.file.write(records.tobytes())
+
+
+def read_event_log(path):
+    """Board edges (edges, 4), frame time step, ball radii and the EVENT_DTYPE records of an event log"""
+    with open(path, 'rb') as file:
+        (_, num_balls, dt), edges = FORMAT.read(file)
+        radii = np.frombuffer(file.read(num_balls * 8), '<f8')
+        events = read_records(file, EVENT_DTYPE)
+    return edges, dt, radii, events
+
+
+def reconstruct(events, num_balls, frames, dt):
+    """Positions and velocities of every ball in the given frames, shape (len(frames), balls, 4)
+
+    Frames before a ball's first record are extrapolated backwards from it."""
+    frames = np.asarray(frames)
+    times = dt * frames
+    # Stable sort: records of a ball in the same frame keep their order, the last one is the state after all of them
+    order = np.lexsort((events['frame'], events['ball']))
+    events = events[order]
+    starts = np.searchsorted(events['ball'], np.arange(num_balls + 1))
+    states = np.full((frames.shape[0], num_balls, 4), np.nan)
+    for ball in range(num_balls):
+        segment = events[starts[ball]:starts[ball + 1]]
+        if segment.shape[0] == 0:
+            continue
+        k = np.maximum(np.searchsorted(segment['frame'], frames, 'right') - 1, 0)
+        last = segment[k]
+        elapsed = times - last['time']
+        states[:, ball, 0] = last['x'] + last['vx'] * elapsed
+        states[:, ball, 1] = last['y'] + last['vy'] * elapsed
+        states[:, ball, 2] = last['vx']
+        states[:, ball, 3] = last['vy']
+    return states
+
+
+def export_trajectory(log_path, trajectory_path, num_frames, output_format='binary', block=256):
+    """Rebuild frames 1..num_frames (frame k at k * dt, as physics.py writes them) as a trajectory file"""
+    edges, dt, radii, events = read_event_log(log_path)
+    num_balls = radii.shape[0]
+    writer = open_writer(trajectory_path, edges, num_balls, output_format)
+    for start in range(1, num_frames + 1, block):
+        states = reconstruct(events, num_balls, np.arange(start, min(start + block, num_frames + 1)), dt)
+        writer.write_frames(writer.records(states[..., :2], states[..., 2:], radii))
+    writer.close()
+
+
+if __name__ == "__main__":
+    # python event_log.py data.events data.traj 1200
+    export_trajectory(sys.argv[1], sys.argv[2], int(sys.argv[3]))
@@ -0,0 +1,234 @@
+import heapq
+from collections import defaultdict
+
+import numpy as np
+
+from broadphase import CollisionGrid
+from swept import SweptWalls
+
+WALL = 0
+CONTACT = 1
+START = 2  # state of a ball when recording begins
+CELL = 3  # a ball moving into the next cell of the contact grid, never recorded
+COMPACT_MIN = 4096  # queue entries below which stale ones are left to be popped
+
+
+class EventEngine:
+    """Exact billiard without friction: balls move in straight lines and the engine jumps from one collision to the next
+
+    Every ball's next wall hit (and next contact when collisions are on) is computed analytically and kept in a
+    priority queue. Each ball's state is only valid at its own last event time. Contacts are only looked for among
+    the balls of the neighbouring cells of a grid as wide as the largest contact distance (see broadphase), which a
+    ball rechecks whenever it moves into another cell, so an event costs O(edges + neighbours) however far apart
+    events are."""
+    def __init__(self, polygon, normals, x, v, radii, collisions=False, chunk_size=None):
+        self.walls = SweptWalls(polygon, normals, chunk_size=chunk_size)
+        self.normals = np.asarray(normals, np.float64)
+        self.x = np.array(x, np.float64)
+        self.v = np.array(v, np.float64)
+        self.radii_sq = np.asarray(radii, np.float64) ** 2
+        self.collisions = collisions
+        n = self.x.shape[0]
+
+        self.time = 0.0
+        self.last_time = np.zeros(n)
+        self.versions = np.zeros(n, np.int64)
+        self.last_edge = np.full(n, -1, np.int64)
+        self.last_partner = np.full(n, -1, np.int64)
+        self.queue = []
+        self.counter = 0
+        self.compact_at = COMPACT_MIN
+        self.wall_count = 0
+        self.contact_count = 0
+
+        # Breakpoints of the piecewise linear trajectories not sampled yet: (ball, time, x, y, vx, vy, kind, edge or
+        # partner), in time order since events are processed in time order
+        self.pending = []
+        # Segment of every ball at the last sampled time (start time, position and velocity there)
+        self.segment_time = np.zeros(n)
+        self.segment_x = self.x.copy()
+        self.segment_v = self.v.copy()
+
+        hit_time, hit_edge = self.walls.first_hit(self.x, self.v, self.last_edge, limit=np.inf)
+        for i in np.flatnonzero(hit_edge >= 0):
+            self.push(hit_time[i], WALL, i, hit_edge[i])
+        if collisions:
+            grid = CollisionGrid(radii)
+            self.cell_size = grid.cell_size
+            # Anchored like the grid's own, so its candidate pairs are exactly the balls in neighbouring cells
+            self.origin = self.x.min(axis=0) if n else np.zeros(2)
+            self.cells = np.floor((self.x - self.origin) / self.cell_size).astype(np.int64)
+            self.members = defaultdict(set)
+            for i, cell in enumerate(map(tuple, self.cells.tolist())):
+                self.members[cell].add(i)
+            first, second = grid.candidate_pairs(self.x)
+            first, second = np.minimum(first, second), np.maximum(first, second)
+            wait = self.meeting_times(first, second)
+            for i, j, s in zip(first.tolist(), second.tolist(), wait.tolist()):
+                if np.isfinite(s):
+                    self.push(s, CONTACT, i, j)
+            for i in range(n):
+                self.schedule_cell(i)
+
+    def push(self, time, kind, ball, other):
+        other_version = self.versions[other] if kind == CONTACT else 0
+        heapq.heappush(self.queue, (time, self.counter, kind, ball, other, self.versions[ball], other_version))
+        self.counter += 1
+
+    def position(self, balls, time):
+        return self.x[balls] + self.v[balls] * (time - self.last_time[balls])[..., None]
+
+    def schedule_wall(self, i):
+        hit_time, hit_edge = self.walls.first_hit(self.x[i:i + 1], self.v[i:i + 1], self.last_edge[i:i + 1], limit=np.inf)
+        if hit_edge[0] >= 0:
+            self.push(self.last_time[i] + hit_time[0], WALL, i, hit_edge[0])
+
+    def schedule_cell(self, i):
+        # Next time ball i moves into another cell, through the side its velocity points to on the axis reached first
+        soonest, side = np.inf, -1
+        for axis, (p, v, cell, origin) in enumerate(zip(self.x[i].tolist(), self.v[i].tolist(),
+                                                        self.cells[i].tolist(), self.origin.tolist())):
+            if v != 0:
+                wait = max((origin + (cell + (v > 0)) * self.cell_size - p) / v, 0.0)
+                if wait < soonest:
+                    soonest, side = wait, 2 * axis + (v > 0)
+        if side >= 0:
+            self.push(self.last_time[i] + soonest, CELL, i, side)
+
+    def cross(self, i, side):
+        """Move ball i into the next cell through side (2 * axis + 1 when moving up that axis) and look for contacts
+        with the balls of the cells that just became neighbours"""
+        axis, up = divmod(side, 2)
+        self.members[tuple(self.cells[i].tolist())].discard(i)
+        self.cells[i, axis] += 1 if up else -1
+        cell = self.cells[i].tolist()
+        self.members[tuple(cell)].add(i)
+        self.schedule_cell(i)
+        entered = []
+        for offset in (-1, 0, 1):
+            neighbour = list(cell)
+            neighbour[axis] += 1 if up else -1
+            neighbour[1 - axis] += offset
+            entered.extend(self.members.get(tuple(neighbour), ()))
+        self.schedule_contacts(i, np.array(entered, np.int64))
+
+    def neighbours(self, i):
+        cx, cy = self.cells[i].tolist()
+        members = self.members
+        return np.array([j for dx in (-1, 0, 1) for dy in (-1, 0, 1) for j in members.get((cx + dx, cy + dy), ())],
+                        np.int64)
+
+    def meeting_times(self, i, others):
+        """Time from now until ball(s) i and others come within contact distance, inf for pairs that never do"""
+        dp = self.position(i, self.time) - self.position(others, self.time)
+        dv = self.v[i] - self.v[others]
+        reach = self.radii_sq[i] + self.radii_sq[others]
+        a = dv[:, 0] * dv[:, 0] + dv[:, 1] * dv[:, 1]
+        b = dp[:, 0] * dv[:, 0] + dp[:, 1] * dv[:, 1]
+        c = dp[:, 0] * dp[:, 0] + dp[:, 1] * dp[:, 1] - reach
+        disc = b * b - a * c
+        # Only approaching pairs whose paths come within the contact distance. Pairs that already overlap (from the
+        # initial placement) pass through each other, bouncing them would repeat forever at the same instant
+        meeting = (b < 0) & (disc >= 0) & (c > -1e-9 * reach)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            wait = np.maximum((-b - np.sqrt(np.maximum(disc, 0))) / a, 0)
+        return np.where(meeting, wait, np.inf)
+
+    def schedule_contacts(self, i, others):
+        others = others[(others != i) & (others != self.last_partner[i])]
+        if others.shape[0] == 0:
+            return
+        wait = self.meeting_times(i, others)
+        meeting = np.isfinite(wait)
+        for j, s in zip(others[meeting].tolist(), wait[meeting].tolist()):
+            self.push(self.time + s, CONTACT, i, j)
+
+    def compact(self):
+        # Every velocity change leaves the ball's earlier predictions in the queue. They are skipped when popped, but
+        # are dropped here once they outnumber the live ones, so the queue stays proportional to the live events
+        versions = self.versions.tolist()
+        self.queue = [entry for entry in self.queue if entry[5] == versions[entry[3]]
+                      and (entry[2] != CONTACT or entry[6] == versions[entry[4]])]
+        heapq.heapify(self.queue)
+        self.compact_at = max(2 * len(self.queue), COMPACT_MIN)
+
+    def record(self, balls, kind, others):
+        self.pending.append(np.column_stack((balls, np.full(len(balls), self.time), self.x[balls], self.v[balls],
+                                             np.full(len(balls), kind), others)))
+
+    def run(self, until):
+        """Process every event up to the given time"""
+        while self.queue and self.queue[0][0] <= until:
+            time, _, kind, i, j, version_i, version_j = heapq.heappop(self.queue)
+            if version_i != self.versions[i] or (kind == CONTACT and version_j != self.versions[j]):
+                continue
+            self.time = time
+            if kind == CELL:
+                self.cross(i, j)
+                continue
+            if kind == WALL:
+                self.x[i] = self.position(i, time)
+                self.last_time[i] = time
+                n = self.normals[j]
+                self.v[i] -= 2 * (self.v[i] @ n) * n
+                self.last_edge[i] = j
+                self.last_partner[i] = -1
+                self.versions[i] += 1
+                self.wall_count += 1
+                self.record(np.array([i]), WALL, [j])
+                changed = (i,)
+            else:
+                pair = np.array([i, j])
+                self.x[pair] = self.position(pair, time)
+                self.last_time[pair] = time
+                normal = self.x[i] - self.x[j]
+                normal /= np.sqrt(normal @ normal)
+                # Each ball bounces off the other like off a wall, unless it is already moving away
+                towards_i = self.v[i] @ normal
+                if towards_i < 0:
+                    self.v[i] -= 2 * towards_i * normal
+                towards_j = self.v[j] @ normal
+                if towards_j > 0:
+                    self.v[j] -= 2 * towards_j * normal
+                self.last_edge[pair] = -1
+                self.last_partner[i] = j
+                self.last_partner[j] = i
+                self.versions[pair] += 1
+                self.contact_count += 1
+                self.record(pair, CONTACT, [j, i])
+                changed = (i, j)
+
+            for k in changed:
+                self.schedule_wall(k)
+                if self.collisions:
+                    self.schedule_cell(k)
+                    self.schedule_contacts(k, self.neighbours(k))
+            if len(self.queue) > self.compact_at:
+                self.compact()
+        self.time = until
+
+    def sample(self, times):
+        """Positions and velocities of every ball at the given increasing times, shape (len(times), balls, 4), no
+        earlier than the last sample
+
+        Also returns the breakpoints up to the last time, in the order they were recorded. They are dropped here, so
+        memory and the cost of a sample only depend on the events since the previous one."""
+        times = np.asarray(times, np.float64)
+        records = np.concatenate(self.pending) if self.pending else np.zeros((0, 8))
+        ends = np.searchsorted(records[:, 1], times, 'right')
+        frames = np.empty((times.shape[0], self.x.shape[0], 4))
+        start = 0
+        for k, time in enumerate(times):
+            if ends[k] > start:
+                # Only the last breakpoint of a ball before this time starts the segment it is on
+                balls = records[start:ends[k], 0].astype(np.int64)[::-1]
+                balls, last = np.unique(balls, return_index=True)
+                rows = records[ends[k] - 1 - last]
+                self.segment_time[balls] = rows[:, 1]
+                self.segment_x[balls] = rows[:, 2:4]
+                self.segment_v[balls] = rows[:, 4:6]
+                start = ends[k]
+            frames[k, :, 2:] = self.segment_v
+            frames[k, :, :2] = self.segment_x + self.segment_v * (time - self.segment_time)[:, None]
+        self.pending = [records[start:]] if start < records.shape[0] else []
+        return frames, records[:start]
@@ -0,0 +1,99 @@
+import numpy as np
+
+
+def edge_geometry(polygon):
+    """Line coefficients (A x + B y + C = 0), unit normals and y ranges of every edge"""
+    As = polygon[:, 1] - polygon[:, 3]
+    Bs = polygon[:, 2] - polygon[:, 0]
+    Cs = polygon[:, 0]*polygon[:, 3] - polygon[:, 2]*polygon[:, 1]
+    normals = np.column_stack((As, Bs))
+    normals /= np.sqrt(As ** 2 + Bs ** 2)[:, None]
+    lower = np.minimum(polygon[:, 1], polygon[:, 3])
+    upper = np.maximum(polygon[:, 1], polygon[:, 3])
+    return As, Bs, Cs, normals, lower, upper
+
+
+def reflect_walls(v, num_intersections, nearest_side, normals):
+    """Bounce the balls that left the table (even crossing count) off their nearest side, returns their indices"""
+    outside = np.flatnonzero(num_intersections % 2 == 0)
+    n = normals[nearest_side[outside]]
+    v[outside] -= 2*(v[outside, 0] * n[:, 0] + v[outside, 1] * n[:, 1])[:, None] * n
+    return outside
+
+
+class EdgeKernel:
+    """Ray-crossing count and nearest side for every (ball, edge) pair in one broadcast pass
+
+    The work matrices are of dtype, float32 halves the memory traffic of the pass."""
+    def __init__(self, As, Bs, Cs, lower, upper, chunk_size=None, dtype=np.float64):
+        self.dtype = np.dtype(dtype)
+        self.As = np.asarray(As, self.dtype)
+        self.Bs = np.asarray(Bs, self.dtype)
+        self.Cs = np.asarray(Cs, self.dtype)
+        self.lower = np.asarray(lower, self.dtype)
+        self.upper = np.asarray(upper, self.dtype)
+        self.chunk_size = chunk_size
+
+        # Horizontal edges (A == 0) never straddle a horizontal ray and are left out of the nearest side search
+        horizontal = self.As == 0
+        self.neg_As = np.where(horizontal, 1, -self.As).astype(self.dtype)
+        self.bias = np.where(horizontal, -np.inf, 0).astype(self.dtype)
+
+        self._rows = 0
+        self._buffers = None
+
+    def scratch(self, rows):
+        # (rows, edges) work matrices, only reallocated when a bigger batch comes in
+        if self._buffers is None or self._rows < rows:
+            shape = (rows, self.As.shape[0])
+            self._buffers = (np.empty(shape, self.dtype), np.empty(shape, self.dtype), np.empty(shape, bool),
+                             np.empty(shape, bool))
+            self._rows = rows
+        return tuple(buffer[:rows] for buffer in self._buffers)
+
+    def __call__(self, x, num_intersections=None, nearest_side=None):
+        n = x.shape[0]
+        if num_intersections is None:
+            num_intersections = np.zeros(n, np.int32)
+        if nearest_side is None:
+            nearest_side = np.zeros(n, np.int32)
+
+        # Chunking bounds the work matrices to chunk_size * edges elements whatever the number of balls
+        step = self.chunk_size or n
+        for start in range(0, n, max(step, 1)):
+            stop = min(start + step, n)
+            self.evaluate(x[start:stop], num_intersections[start:stop], nearest_side[start:stop])
+        return num_intersections, nearest_side
+
+    def evaluate(self, x, num_intersections, nearest_side):
+        by, work, crossed, within = self.scratch(x.shape[0])
+        px = x[:, 0:1]
+        py = x[:, 1:2]
+
+        # x of the point where each edge's line meets the ball's horizontal ray
+        np.multiply(self.Bs, py, out=by)
+        np.add(self.Cs, by, out=work)
+        np.divide(work, self.neg_As, out=work)
+        np.less(work, px, out=crossed)
+        np.less(self.lower, py, out=within)
+        crossed &= within
+        np.less(py, self.upper, out=within)
+        crossed &= within
+        np.sum(crossed, axis=1, dtype=np.int32, out=num_intersections)
+
+        # Signed proximity to each edge's line, the nearest side is the first edge with the largest positive value
+        np.multiply(self.As, px, out=work)
+        work += by
+        work += self.Cs
+        work += self.bias
+        np.argmax(work, axis=1, out=nearest_side)
+        closest = np.take_along_axis(work, nearest_side[:, None], axis=1)[:, 0]
+        nearest_side[~(closest > 0)] = 0
+
+
+def expand_ranges(starts, counts):
+    """Flatten the ranges [starts[k], starts[k] + counts[k]) into (k, position) index pairs"""
+    counts = np.maximum(counts, 0)
+    owners = np.repeat(np.arange(counts.shape[0]), counts)
+    offsets = np.arange(owners.shape[0]) - np.repeat(np.cumsum(counts) - counts, counts)
+    return owners, np.repeat(starts, counts) + offsets
@@ -0,0 +1,292 @@
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from board_cache import CACHE_DIR, compiled_board
+from sweep import COLUMNS, SQUARE, init_worker, load_board, parameter_grid, point_key, run_point
+
+# Sweep directory layout, on a filesystem every worker host mounts:
+#   manifest.json        boards (edge lists), lease length and number of shards, written last so workers only ever
+#                        see a complete sweep
+#   shards/NNNNN.json    the points (sweep.PARAMETERS) of each shard
+#   locks/NNNNN.lock     the claim of the worker running the shard, created with O_EXCL so only one worker gets it.
+#                        Its owner touches it every lease / 3 seconds, a lock untouched for lease seconds has expired
+#                        and any worker may take the shard over
+#   results/NNNNN.json   the result rows of a finished shard (as sweep.run_point returns them), renamed into place in
+#                        one step: a shard is done once its results exist
+#   output/              trajectories of every point, when the sweep was created with output set
+# No service coordinates the workers. A lease that expires while its owner is only slow (or cut off from the
+# filesystem) can get a shard run twice, but runs are seeded, so the second commit writes the same rows again.
+VERSION = 1
+SHARD_SIZE = 8  # points per shard
+LEASE_SECONDS = 300.0  # how long a lock may go untouched before its shard is reclaimed
+POLL_SECONDS = 10.0  # wait between looks for reclaimable shards while others are still running
+
+
+def shard_name(index):
+    return f"{index:05d}"
+
+
+def write_json(path, data):
+    # Written next to path then renamed over it, so readers never see half a file
+    temporary = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(temporary, 'w') as file:
+        json.dump(data, file)
+    os.replace(temporary, path)
+
+
+def read_json(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def create_sweep(directory, grid, boards, shard_size=SHARD_SIZE, lease=LEASE_SECONDS, output=False):
+    """Write the points of grid (see sweep.parameter_grid) to directory as shards of shard_size points"""
+    if os.path.exists(os.path.join(directory, 'manifest.json')):
+        raise FileExistsError(f"{directory} already holds a sweep")
+    for name in ('shards', 'locks', 'results') + (('output',) if output else ()):
+        os.makedirs(os.path.join(directory, name), exist_ok=True)
+    shards = [grid[start:start + shard_size] for start in range(0, len(grid), shard_size)]
+    for index, points in enumerate(shards):
+        write_json(os.path.join(directory, 'shards', f"{shard_name(index)}.json"), {'points': points})
+    write_json(os.path.join(directory, 'manifest.json'),
+               {'version': VERSION, 'shards': len(shards), 'points': len(grid), 'lease': lease, 'output': output,
+                'boards': {name: np.asarray(polygon, np.float64).tolist() for name, polygon in boards.items()}})
+
+
+def load_manifest(directory):
+    manifest = read_json(os.path.join(directory, 'manifest.json'))
+    if manifest['version'] > VERSION:
+        raise ValueError(f"Sweep version {manifest['version']} is newer than this worker ({VERSION})")
+    return manifest
+
+
+class Lease:
+    """Claim on one shard: the lock file holding the owner's token, touched from a thread while the shard runs"""
+    def __init__(self, path, owner, lease):
+        self.path = path
+        self.owner = owner
+        self.lease = lease
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @classmethod
+    def claim(cls, path, owner, lease):
+        """The lease on the shard of lock path, or None when a live worker holds it"""
+        for _ in range(2):
+            try:
+                descriptor = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not expired(path, lease) or not break_lock(path, owner, lease):
+                    return None
+                continue
+            with os.fdopen(descriptor, 'w') as file:
+                json.dump({'owner': owner, 'host': socket.gethostname(), 'pid': os.getpid(), 'claimed': time.time()},
+                          file)
+            return cls(path, owner, lease)
+        return None
+
+    def holder(self):
+        try:
+            return read_json(self.path)['owner']
+        except (OSError, ValueError):
+            return None
+
+    def renew(self):
+        while not self.stopped.wait(self.lease / 3):
+            if self.holder() != self.owner:
+                # Taken over after an expiry: carry on, the shard's results are the same whoever commits them
+                self.lost = True
+                return
+            try:
+                os.utime(self.path)
+            except OSError:
+                self.lost = True
+                return
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.renew, name='lease-renewal', daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+        if self.holder() == self.owner:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+def expired(path, lease):
+    try:
+        return time.time() - os.stat(path).st_mtime > lease
+    except FileNotFoundError:
+        return True
+
+
+def break_lock(path, owner, lease):
+    """Remove an expired lock, whether this worker may now try to claim the shard
+
+    The lock is first renamed to a name of this worker's, which only one of the workers racing for it manages. A lock
+    claimed afresh in between is linked back (link fails rather than overwrite a newer claim)."""
+    stale = f"{path}.{owner}.stale"
+    try:
+        os.rename(path, stale)
+    except FileNotFoundError:
+        return False
+    if not expired(stale, lease):
+        try:
+            os.link(stale, path)
+        except FileExistsError:
+            pass
+        os.remove(stale)
+        return False
+    os.remove(stale)
+    return True
+
+
+def shard_state(directory, index, lease):
+    name = shard_name(index)
+    if os.path.exists(os.path.join(directory, 'results', f"{name}.json")):
+        return 'done'
+    if not expired(os.path.join(directory, 'locks', f"{name}.lock"), lease):
+        return 'running'
+    return 'pending'
+
+
+def run_shard(directory, index, manifest, owner, board_cache=CACHE_DIR):
+    name = shard_name(index)
+    points = read_json(os.path.join(directory, 'shards', f"{name}.json"))['points']
+    output_dir = os.path.join(directory, 'output') if manifest['output'] else None
+    rows = [{**run_point(point, output_dir, board_cache), 'key': point_key(point)} for point in points]
+    write_json(os.path.join(directory, 'results', f"{name}.json"),
+               {'shard': index, 'owner': owner, 'host': socket.gethostname(), 'rows': rows})
+    return rows
+
+
+def run_worker(directory, max_shards=None, wait=True, board_cache=CACHE_DIR, progress=print):
+    """Claim, run and commit shards of the sweep in directory until none is left (or max_shards are done)
+
+    With wait set, a worker that finds every remaining shard claimed keeps polling for leases that expire instead of
+    returning. Returns the number of shards this worker committed."""
+    manifest = load_manifest(directory)
+    init_worker({name: np.array(polygon, np.float64) for name, polygon in manifest['boards'].items()})
+    if board_cache is not None:
+        for polygon in manifest['boards'].values():
+            compiled_board(np.array(polygon, np.float64), board_cache)
+    owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    lease = manifest['lease']
+    # Every worker goes through the shards from its own starting point, so they rarely race for the same lock
+    first = random.Random(owner).randrange(max(manifest['shards'], 1))
+    order = [(first + k) % manifest['shards'] for k in range(manifest['shards'])]
+    committed = 0
+    while max_shards is None or committed < max_shards:
+        claimed = False
+        busy = False
+        for index in order:
+            state = shard_state(directory, index, lease)
+            busy |= state == 'running'
+            if state != 'pending':
+                continue
+            path = os.path.join(directory, 'locks', f"{shard_name(index)}.lock")
+            lease_held = Lease.claim(path, owner, lease)
+            if lease_held is None:
+                busy = True
+                continue
+            with lease_held:
+                # Committed by another worker between the state check and the claim
+                if shard_state(directory, index, lease) != 'done':
+                    rows = run_shard(directory, index, manifest, owner, board_cache)
+                    committed += 1
+                    progress(f"{owner}: shard {index} committed, "
+                             f"{sum(row['status'] == 'done' for row in rows)}/{len(rows)} points done")
+            claimed = True
+            break
+        if claimed:
+            continue
+        if not busy or not wait:
+            return committed
+        time.sleep(min(POLL_SECONDS, lease / 3))
+    return committed
+
+
+def sweep_status(directory):
+    """Number of shards done, running (under a live lease) and pending"""
+    manifest = load_manifest(directory)
+    states = [shard_state(directory, index, manifest['lease']) for index in range(manifest['shards'])]
+    return {state: states.count(state) for state in ('done', 'running', 'pending')}
+
+
+def collect_results(directory, results_path=None):
+    """Result rows of every committed shard, also written to results_path (a sweep.COLUMNS table) when given"""
+    manifest = load_manifest(directory)
+    rows = []
+    for index in range(manifest['shards']):
+        path = os.path.join(directory, 'results', f"{shard_name(index)}.json")
+        if os.path.exists(path):
+            rows.extend(read_json(path)['rows'])
+    if results_path is not None:
+        with open(results_path, 'w', newline='') as file:
+            table = csv.DictWriter(file, COLUMNS, extrasaction='ignore')
+            table.writeheader()
+            table.writerows(rows)
+    return rows
+
+
+def run_local(directory, processes, board_cache=CACHE_DIR):
+    """Run processes workers on this machine, like as many hosts sharing the directory"""
+    workers = [multiprocessing.Process(target=run_worker, args=(directory,), kwargs={'board_cache': board_cache})
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return [worker.exitcode for worker in workers]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sweeps shared between workers through a directory")
+    commands = parser.add_subparsers(dest='command', required=True)
+    create = commands.add_parser('create', help="write the sweep of sweep.py's default grid over the given boards")
+    create.add_argument('directory')
+    create.add_argument('boards', nargs='*', help="board files exported by PolygonCreator, swept along with the square")
+    create.add_argument('--shard-size', type=int, default=SHARD_SIZE)
+    create.add_argument('--lease', type=float, default=LEASE_SECONDS)
+    create.add_argument('--output', action='store_true', help="keep the trajectory of every point")
+    work = commands.add_parser('work', help="claim and run shards until the sweep is done")
+    work.add_argument('directory')
+    work.add_argument('--processes', type=int, default=1)
+    work.add_argument('--shards', type=int, default=None, help="stop after this many shards")
+    status = commands.add_parser('status')
+    status.add_argument('directory')
+    collect = commands.add_parser('collect', help="gather the committed results into a CSV table")
+    collect.add_argument('directory')
+    collect.add_argument('results', nargs='?', default='sweep_results.csv')
+    args = parser.parse_args()
+
+    if args.command == 'create':
+        boards = {'square': SQUARE}
+        for path in args.boards:
+            boards[os.path.splitext(os.path.basename(path))[0]] = load_board(path)
+        grid = parameter_grid(board=list(boards), mu=[1, 0.999], num_balls=[10, 100], seed=range(4))
+        create_sweep(args.directory, grid, boards, args.shard_size, args.lease, args.output)
+    elif args.command == 'work' and args.processes > 1:
+        run_local(args.directory, args.processes)
+    elif args.command == 'work':
+        run_worker(args.directory, args.shards)
+    elif args.command == 'status':
+        print(sweep_status(args.directory))
+    else:
+        print(f"{len(collect_results(args.directory, args.results))} rows written to {args.results}")
@@ -0,0 +1,188 @@
+import multiprocessing
+import threading
+from multiprocessing.connection import wait
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from broadphase import CollisionGrid, resolve_collisions
+from kernels import reflect_walls
+
+RUN = 0
+STOP = 1
+STRIP_SAMPLES = 16384  # positions sampled to place the strip boundaries
+
+
+def shard(num_balls, workers, rank):
+    """Index range [start, stop) of one worker's balls"""
+    bounds = np.linspace(0, num_balls, workers + 1).astype(np.int64)
+    return bounds[rank], bounds[rank + 1]
+
+
+def strip_bounds(x, workers, rank):
+    """x range of one worker's strip, with boundaries at quantiles of the positions so every strip gets as many balls
+
+    Every worker derives the same boundaries from the same (shared) positions."""
+    if x.shape[0] == 0:
+        return -np.inf, np.inf
+    stride = max(1, x.shape[0] // STRIP_SAMPLES)
+    edges = np.quantile(x[::stride, 0], np.linspace(0, 1, workers + 1)[1:-1])
+    lo = edges[rank - 1] if rank > 0 else -np.inf
+    hi = edges[rank] if rank < workers - 1 else np.inf
+    return lo, hi
+
+
+def strip_collisions(x, v, collision_grid, lo, hi):
+    """Contacts of the balls in the strip lo <= x < hi, resolved on copies of the strip and a halo one contact
+    distance wide on each side
+
+    The pairs among the strip and its halo are resolved in the same order as over the whole board, only the
+    contacts of halo balls with balls beyond the halo are missing. Returns the strip's indices, new positions and
+    velocities, and the number of contacts this strip counts (those whose lower-indexed ball it owns)."""
+    reach = collision_grid.cell_size
+    px = x[:, 0]
+    local = np.flatnonzero((px >= lo - reach) & (px < hi + reach))
+    owned = (px[local] >= lo) & (px[local] < hi)
+    lx = x[local]
+    lv = v[local]
+    radii_sq = collision_grid.radii_sq[local]
+    i, j = collision_grid.candidate_pairs(lx) if local.shape[0] else (local, local)
+    # Local indices keep the order of the global ones, so the lower one is i
+    i, j = resolve_collisions(lx, lv, radii_sq, i, j)
+    contacts = np.count_nonzero(owned[i])
+    return local[owned], lx[owned], lv[owned], contacts
+
+
+def views(memory, num_balls, num_edges, dtype, workers):
+    """Arrays over the shared blocks: x, v, radii, control word and per-worker counters (wall bounces, contacts,
+    then the wall bounces off each edge)"""
+    return (np.ndarray((num_balls, 2), dtype, memory[0].buf), np.ndarray((num_balls, 2), dtype, memory[1].buf),
+            np.ndarray(num_balls, dtype, memory[2].buf), np.ndarray(1, np.int64, memory[3].buf),
+            np.ndarray((workers, 2 + num_edges), np.int64, memory[4].buf))
+
+
+def worker(rank, workers, names, num_balls, dtype, edge_kernel, swept_walls, normals, dt, mu, collisions, swept,
+           start, done, peers):
+    """Steps the balls of one index shard, and with collisions the contacts of one strip, frame after frame"""
+    memory = [SharedMemory(name) for name in names]
+    x, v, radii, control, counts = views(memory, num_balls, normals.shape[0], dtype, workers)
+    first, last = shard(num_balls, workers, rank)
+    xs, vs = x[first:last], v[first:last]
+    num_intersections = np.zeros(last - first, np.int32)
+    nearest_side = np.zeros(last - first, np.int32)
+    collision_grid = CollisionGrid(radii) if collisions else None
+    try:
+        while True:
+            start.wait()
+            if control[0] == STOP:
+                break
+            if swept:
+                bounced, edges, _ = swept_walls.advance(xs, vs, dt)
+                vs *= mu
+            else:
+                xs += vs * dt
+                vs *= mu
+                edge_kernel(xs, num_intersections, nearest_side)
+                bounced = reflect_walls(vs, num_intersections, nearest_side, normals)
+                edges = nearest_side[bounced]
+            counts[rank, 0] += len(bounced)
+            counts[rank, 2:] += np.bincount(edges, minlength=normals.shape[0])
+            if collisions:
+                # Every shard has moved before the strips are read, and every strip is resolved before any is written
+                peers.wait()
+                balls, new_x, new_v, contacts = strip_collisions(x, v, collision_grid, *strip_bounds(x, workers, rank))
+                peers.wait()
+                x[balls] = new_x
+                v[balls] = new_v
+                counts[rank, 1] += contacts
+            done.wait()
+    except threading.BrokenBarrierError:
+        pass
+    except BaseException:
+        # Wake everyone up rather than leave them waiting on a worker that is gone
+        for barrier in (start, done, peers):
+            barrier.abort()
+        raise
+    finally:
+        del x, v, radii, control, counts, xs, vs
+        for block in memory:
+            block.close()
+
+
+class ParallelStepper:
+    """Steps a Simulation's balls in worker processes that share its state arrays
+
+    The x, v and radii of the simulation are moved into shared memory, so frames cost two barriers and no copies.
+    Walls are handled in contiguous index shards. Contacts are resolved per vertical strip of the board, each worker
+    reading the neighbouring balls within reach (its halo) straight from the shared arrays and writing back only its
+    own. A ball near a strip boundary can miss the effect of a contact beyond the halo that comes earlier in the
+    order of contacts, so runs with collisions can stray from the serial ones where balls crowd across a boundary."""
+    def __init__(self, simulation, workers):
+        self.workers = workers
+        n = simulation.x.shape[0]
+        dtype = simulation.dtype
+        num_edges = simulation.normals.shape[0]
+        sizes = (n * 2 * dtype.itemsize, n * 2 * dtype.itemsize, n * dtype.itemsize, 8, workers * (2 + num_edges) * 8)
+        self.memory = [SharedMemory(create=True, size=max(size, 1)) for size in sizes]
+        names = [block.name for block in self.memory]
+        self.x, self.v, self.radii, self.control, self.counts = views(self.memory, n, num_edges, dtype, workers)
+        self.x[:] = simulation.x
+        self.v[:] = simulation.v
+        self.radii[:] = simulation.radii
+        self.control[0] = RUN
+        self.counts[:] = 0
+        simulation.x, simulation.v, simulation.radii = self.x, self.v, self.radii
+
+        context = multiprocessing.get_context()
+        self.start = context.Barrier(workers + 1)
+        self.done = context.Barrier(workers + 1)
+        # Kept here as well: the workers only unpickle the barriers once started (spawn and forkserver), and by then
+        # Process.start() has let go of its arguments
+        self.peers = context.Barrier(workers)
+        self.processes = [context.Process(target=worker, name=f'stepper-{rank}', daemon=True,
+                                          args=(rank, workers, names, n, dtype, simulation.edge_kernel,
+                                                simulation.swept_walls, simulation.normals, simulation.dt,
+                                                simulation.mu, simulation.collisions, simulation.swept, self.start,
+                                                self.done, self.peers))
+                          for rank in range(workers)]
+        for process in self.processes:
+            process.start()
+        self.closing = False
+        self.watcher = threading.Thread(target=self.watch, name='stepper-watcher', daemon=True)
+        self.watcher.start()
+
+    def watch(self):
+        # A worker that dies (killed, out of memory, ...) never reaches the barriers again: break them, so step()
+        # raises instead of waiting forever
+        wait([process.sentinel for process in self.processes])
+        if not self.closing:
+            for barrier in (self.start, self.done, self.peers):
+                barrier.abort()
+
+    def step(self):
+        """One frame, returns the wall bounces and contacts it took and the bounces off each edge"""
+        before = self.counts.sum(axis=0)
+        try:
+            self.start.wait()
+            self.done.wait()
+        except threading.BrokenBarrierError:
+            raise RuntimeError("A stepping worker failed") from None
+        counts = self.counts.sum(axis=0) - before
+        return int(counts[0]), int(counts[1]), counts[2:]
+
+    def close(self, simulation):
+        """Stop the workers and hand the simulation private copies of its arrays again"""
+        self.closing = True
+        self.control[0] = STOP
+        try:
+            self.start.wait()
+        except threading.BrokenBarrierError:
+            pass
+        for process in self.processes:
+            process.join()
+        self.watcher.join()
+        simulation.x, simulation.v, simulation.radii = self.x.copy(), self.v.copy(), self.radii.copy()
+        del self.x, self.v, self.radii, self.control, self.counts
+        for block in self.memory:
+            block.close()
+            block.unlink()
@@ -1,18 +1,53 @@
 import numpy as np
+import os
 import random
 
+from adaptive import StepController, damping
+from analytics import MetricsWriter
+from archive import open_archive
+from board_cache import board_key, compiled_board, make_edge_kernel
+from broadphase import CollisionGrid, resolve_collisions
+from checkpoint import Checkpointer, load_checkpoint
+from ensemble import initial_state
+from event_log import EventLogWriter
+from events import CONTACT, START, WALL, EventEngine
+from kernels import edge_geometry, reflect_walls
+from parallel import ParallelStepper
+from profiler import NULL_PROFILER, Profiler
+from swept import SweptWalls
+from trajectory import open_writer
+
 # Constants
 NUM_BALLS = 100
 FRAMES = 1200
-OUTPUT_PATH = 'data.txt'
+OUTPUT_PATH = 'data.traj'  # None to skip the frames, e.g. when only the event log is wanted
+OUTPUT_FORMAT = 'binary'  # or 'text' for the original data.txt format, or 'archive' for compressed chunks (archive.py)
+BACKGROUND_OUTPUT = True  # write frames from a separate thread
+EVENT_LOG_PATH = None  # e.g. 'data.events': every bounce and contact, any frame can be rebuilt from it (needs mu = 1)
+METRICS_PATH = None  # e.g. 'data.metrics': center of mass, energy, momentum, wall hits and occupancy of every frame
 MAX_V = 1
 dt = 0.0025
 epsilon = -0.2
 sensitivity = 0
 mu = 1 #0.99
 attenuation = 1
-collision_count = 0
 collisions = False
+CHUNK_SIZE = None  # balls per pass of the edge kernel and the swept wall test, None to test every ball at once
+SWEPT = False  # bounce at the exact crossing point, so dt can be much larger
+EVENT_DRIVEN = False  # jump from collision to collision instead of stepping, needs mu = 1
+EDGE_INDEX = False  # bucket the edges on a grid, pays off on boards with hundreds of sides
+DISTANCE_FIELD = False  # look containment up in a rasterized board, only balls next to a wall take the exact test
+FIELD_RESOLUTION = None  # cells along the longer side of the board, None for 16 * sqrt(edges)
+TRIANGULATED = False  # walk each ball through a triangulation of the board from its triangle of the last frame
+DTYPE = np.float64  # of the state, edge geometry and output, np.float32 once precision.py shows the board allows it
+BOARD_CACHE = 'board_cache'  # directory of compiled boards, None to derive the geometry on every run
+ADAPTIVE = False  # swept steps sized from the fastest ball and the smallest board features, frames still every dt
+REST_SPEED = None  # e.g. 1e-3 with mu < 1: balls slower than this stop and are no longer stepped
+WORKERS = 1  # processes stepping the balls together over shared memory, see parallel.py
+PROFILE = False  # time each phase of the step loop and count bounces, contacts and bytes written
+PROFILE_INTERVAL = None  # frames between JSON progress lines on stderr while profiling, None for a summary at the end
+CHECKPOINT_PATH = None  # e.g. 'data.checkpoint.npz': a rerun carries on from it, appending to the output
+CHECKPOINT_INTERVAL = 200  # frames between checkpoints, the last frame is always saved
 
 # Bounds
 #polygon = np.array([[0, 0, 1, 0], [1, 0, 1, 1], [1, 1, 0, 1], [0, 1, 0, 0]])
@@ -27,78 +62,466 @@ collisions = False
 #polygon = np.array([[0.11659663865546219, 0.7058823529411765, 0.555672268907563, 0.3182773109243697], [0.555672268907563, 0.3182773109243697, 1.0, 0.7384453781512605], [1.0, 0.7384453781512605, 0.5525210084033614, 0.16596638655462184], [0.5525210084033614, 0.16596638655462184, 0.11659663865546219, 0.7058823529411765]])
 polygon = np.array([[0.23968393327480245, 0.30465320456540823, 0.2721685689201054, 0.24934152765583845], [0.2721685689201054, 0.24934152765583845, 0.3485513608428446, 0.17559262510974538], [0.3485513608428446, 0.17559262510974538, 0.45390693590869186, 0.12554872695346794], [0.45390693590869186, 0.12554872695346794, 0.607550482879719, 0.1141352063213345], [0.607550482879719, 0.1141352063213345, 0.7436347673397717, 0.1299385425812116], [0.7436347673397717, 0.1299385425812116, 0.8595258999122037, 0.16769095697980685], [0.8595258999122037, 0.16769095697980685, 0.9376646180860404, 0.22388059701492538], [0.9376646180860404, 0.22388059701492538, 0.990342405618964, 0.295873573309921], [0.990342405618964, 0.295873573309921, 1.0, 0.3582089552238806], [1.0, 0.3582089552238806, 0.9420544337137841, 0.36259877085162423], [0.9420544337137841, 0.36259877085162423, 0.9139596136962248, 0.3301141352063213], [0.9139596136962248, 0.3301141352063213, 0.8691834942932397, 0.3257243195785777], [0.8691834942932397, 0.3257243195785777, 0.8340649692712906, 0.34416154521510095], [0.8340649692712906, 0.34416154521510095, 0.8173836698858647, 0.37576821773485514], [0.8173836698858647, 0.37576821773485514, 0.8226514486391572, 0.4196663740122915], [0.8226514486391572, 0.4196663740122915, 0.8472344161545216, 0.44512730465320455], [0.8472344161545216, 0.44512730465320455, 0.8955223880597015, 0.45390693590869186], [0.8955223880597015, 0.45390693590869186, 0.9280070237050044, 0.4363476733977173], [0.9280070237050044, 0.4363476733977173, 0.9438103599648815, 0.4117647058823529], [0.9438103599648815, 0.4117647058823529, 1.0, 0.4161545215100966], [1.0, 0.4161545215100966, 0.990342405618964, 0.4942932396839333], [0.990342405618964, 0.4942932396839333, 0.9350307287093942, 0.5618964003511853], [0.9350307287093942, 0.5618964003511853, 0.8568920105355575, 0.5970149253731343], [0.8568920105355575, 0.5970149253731343, 0.7489025460930641, 0.6251097453906936], [0.7489025460930641, 0.6251097453906936, 0.6400351185250219, 0.6356453028972783], [0.6400351185250219, 0.6356453028972783, 0.5171202809482002, 0.6356453028972783], [0.5171202809482002, 0.6356453028972783, 0.3784021071115013, 0.6014047410008779], [0.3784021071115013, 0.6014047410008779, 0.27568042142230026, 0.553116769095698], [0.27568042142230026, 0.553116769095698, 0.23002633889376647, 0.4811237928007024], [0.23002633889376647, 0.4811237928007024, 0.22300263388937663, 0.4161545215100966], [0.22300263388937663, 0.4161545215100966, 0.28094820017559263, 0.4100087796312555], [0.28094820017559263, 0.4100087796312555, 0.30026338893766463, 0.43898156277436345], [0.30026338893766463, 0.43898156277436345, 0.33099209833187004, 0.4591747146619842], [0.33099209833187004, 0.4591747146619842, 0.37664618086040386, 0.4556628621597893], [0.37664618086040386, 0.4556628621597893, 0.4108867427568042, 0.4310798946444249], [0.4108867427568042, 0.4310798946444249, 0.41878841088674273, 0.3801580333625988], [0.41878841088674273, 0.3801580333625988, 0.4003511852502195, 0.3388937664618086], [0.4003511852502195, 0.3388937664618086, 0.3582089552238806, 0.32660228270412645], [0.3582089552238806, 0.32660228270412645, 0.31431079894644426, 0.334503950834065], [0.31431079894644426, 0.334503950834065, 0.2870939420544337, 0.3652326602282704], [0.2870939420544337, 0.3652326602282704, 0.23002633889376647, 0.3520632133450395], [0.23002633889376647, 0.3520632133450395, 0.23968393327480245, 0.30465320456540823]])
 
-radii = np.full(NUM_BALLS, 1/20)#[random.uniform(1, 1) for _ in range(NUM_BALLS)]
-radii_sq = radii * radii
-As = polygon[:, 1] - polygon[:, 3]
-Bs = polygon[:, 2] - polygon[:, 0]
-normals = np.array(list(zip(As, Bs)), np.float64)
-magnitudes = np.sqrt(normals[:, 0] ** 2 + normals[:, 1]**2)
-print(normals)
-print(magnitudes)
-normals /= magnitudes[:, None]
-print(normals)
-Cs = polygon[:, 0]*polygon[:, 3] - polygon[:, 2]*polygon[:, 1]
-lower = np.min(np.dstack((polygon[:, 1], polygon[:, 3])), 2)[0]
-upper = np.max(np.dstack((polygon[:, 1], polygon[:, 3])), 2)[0]
-#intercepts = polygon[:, 3] - slopes * polygon[:, 2]
-BOUNDS = np.min(polygon[:, ::2]), np.max(polygon[:, ::2]), np.min(polygon[:, 1::2]), np.max(polygon[:, 1::2])
-SIZE = BOUNDS[1] - BOUNDS[0], BOUNDS[3] - BOUNDS[2]
-# Variables
-#x = np.array([[0.2, 0], [1.7, 0.05]])
-x = np.array([np.random.uniform(BOUNDS[0] - SIZE[0] * epsilon, BOUNDS[1] + SIZE[0] * epsilon, NUM_BALLS), np.random.uniform(BOUNDS[2] - SIZE[1] * epsilon, BOUNDS[3] + SIZE[1] * epsilon, NUM_BALLS)], np.float64).T
-#xprev = x.copy()
-#v = np.array([[1, 0.01], [-1, 0]])#
-v = np.random.standard_normal((NUM_BALLS, 2)) * MAX_V
-file = open(OUTPUT_PATH, 'w')
-for side in polygon:
-    file.write(f"{side[0]} {side[1]} {side[2]} {side[3]} ")
-file.write("\n")
-
-
-def magnitude_sq(vec):
-    return vec[0] * vec[0] + vec[1] * vec[1]
-for n in range(FRAMES):
-    x += v * dt
-    v *= mu
-    num_intersections = np.zeros(NUM_BALLS, np.int32)
-    nearest_side = np.zeros(NUM_BALLS, np.int32)
-    closest = np.full(NUM_BALLS, 0, np.float64)
-    for i in range(polygon.shape[0]): #for each edge
-        if (As[i] == 0):
-            num_intersections += x[:, 1] == Cs[i]
+
+
+class Simulation:
+    """Balls on a board, stepped frame by frame
+
+    The state is kept as arrays (x, v and radii of every ball) next to the precomputed edge geometry, so the same
+    object can be stepped, inspected and stepped again. The options pick the stepper, see the constants above."""
+    def __init__(self, polygon, num_balls=NUM_BALLS, dt=dt, mu=mu, epsilon=epsilon, max_v=MAX_V, radius=1/20,
+                 collisions=collisions, swept=SWEPT, event_driven=EVENT_DRIVEN, edge_index=EDGE_INDEX,
+                 distance_field=DISTANCE_FIELD, field_resolution=FIELD_RESOLUTION, triangulated=TRIANGULATED,
+                 chunk_size=CHUNK_SIZE, board_cache=BOARD_CACHE, dtype=DTYPE, adaptive=ADAPTIVE, workers=WORKERS, rest_speed=REST_SPEED,
+                 rng=None):
+        self.polygon = np.asarray(polygon, np.float64)
+        self.dt = dt
+        self.mu = mu
+        self.collisions = collisions
+        self.swept = swept
+        self.event_driven = event_driven
+        self.dtype = np.dtype(dtype)
+        self.board = None
+        if board_cache is not None:
+            self.board = compiled_board(self.polygon, board_cache)
+            geometry = self.board.geometry()
+        else:
+            geometry = edge_geometry(self.polygon)
+        self.As, self.Bs, self.Cs, self.normals, self.lower, self.upper = (np.asarray(array, self.dtype)
+                                                                           for array in geometry)
+
+        self.rng = np.random.default_rng(rng)
+        x, v = initial_state(self.polygon, 1, num_balls, epsilon, max_v, self.rng)
+        self.x = x[0].astype(self.dtype)
+        self.v = v[0].astype(self.dtype)
+        self.radii = np.full(num_balls, radius, self.dtype)
+        self.frame = 0
+        self.wall_count = 0
+        self.collision_count = 0
+        self.sinks = []
+        self.event_sinks = []
+        self.metrics_sinks = []
+        self.edge_hits = np.zeros(self.polygon.shape[0], np.int64)
+        self.profiler = NULL_PROFILER
+        self.checkpointer = None
+
+        self.num_intersections = np.zeros(num_balls, np.int32)
+        self.nearest_side = np.zeros(num_balls, np.int32)
+        self.edge_kernel = make_edge_kernel(self.polygon, self.As, self.Bs, self.Cs, self.lower, self.upper, self.board,
+                                            triangulated, distance_field, field_resolution, edge_index, chunk_size,
+                                            self.dtype)
+        self.collision_grid = CollisionGrid(self.radii) if collisions else None
+        self.swept_walls = SweptWalls(self.polygon, self.normals, chunk_size=chunk_size)
+        self.engine = None
+        if event_driven:
+            if mu != 1:
+                raise ValueError("The event-driven engine only handles mu = 1")
+            self.engine = EventEngine(self.polygon, self.normals, self.x, self.v, self.radii, collisions, chunk_size)
+        self.rest_speed = rest_speed
+        self.active = None
+        if rest_speed is not None:
+            if mu >= 1:
+                raise ValueError("Balls only come to rest when mu < 1")
+            if adaptive or workers > 1:
+                raise ValueError("Rest detection only works with the fixed or swept stepper in one process")
+            # Indices of the balls still moving, in increasing order
+            self.active = np.arange(num_balls)
+        self.parallel = None
+        if workers > 1:
+            if event_driven:
+                raise ValueError("The event-driven engine runs in one process")
+            self.parallel = ParallelStepper(self, workers)
+        self.controller = None
+        self.clock = 0.0
+        if adaptive:
+            if event_driven or workers > 1:
+                raise ValueError("Adaptive steps only work with the fixed or swept stepper in one process")
+            self.controller = StepController(self.polygon, dt, self.radii if collisions else None)
+            # Start of the last step (time, x, v, balls that bounced in it) and the bounces (time, edge) of the
+            # frames not written yet
+            self.segment = (0.0, self.x.copy(), self.v.copy(), np.zeros(0, np.int64))
+            self.pending_bounces = (np.zeros(0), np.zeros(0, np.int64))
+
+    def add_sink(self, sink):
+        """Hand every frame to sink, anything with write_frame(x, v, radii) and close() like the trajectory writers"""
+        self.sinks.append(sink)
+        return sink
+
+    def add_event_sink(self, sink, start=True):
+        """Log every velocity change to sink (an event_log.EventLogWriter), starting with the current state unless
+        start is off (a log resumed from a checkpoint already has it)"""
+        if self.mu != 1:
+            raise ValueError("Frames can only be rebuilt from the event log when mu = 1")
+        if self.parallel is not None or self.controller is not None:
+            raise ValueError("Events are only logged with one process and fixed steps")
+        self.event_sinks.append(sink)
+        if start:
+            sink.write_events(np.arange(self.x.shape[0]), self.frame, self.frame * self.dt, START, -1, self.x, self.v)
+        return sink
+
+    def add_metrics_sink(self, sink):
+        """Hand the observables of every frame to sink (an analytics.MetricsWriter)"""
+        self.metrics_sinks.append(sink)
+        return sink
+
+    def log_events(self, balls, frames, times, kind, others, x, v):
+        for sink in self.event_sinks:
+            sink.write_events(balls, frames, times, kind, others, x, v)
+
+    def checkpoint_every(self, path, interval):
+        """Save a checkpoint to path every interval frames, from a background thread"""
+        if self.engine is not None:
+            raise ValueError("The event-driven engine cannot be checkpointed")
+        self.checkpointer = Checkpointer(path, interval)
+        return self.checkpointer
+
+    def checkpoint(self):
+        """Queue a checkpoint of the current frame"""
+        self.checkpointer.save(self.snapshot())
+
+    def snapshot(self):
+        """Copy of everything a checkpoint holds, with a mark in every sink for the offset it reached"""
+        return {'board': board_key(self.polygon), 'dt': self.dt, 'x': self.x.copy(), 'v': self.v.copy(),
+                'radii': self.radii.copy(), 'frame': self.frame, 'wall_count': self.wall_count,
+                'collision_count': self.collision_count, 'rng': self.rng.bit_generator.state,
+                'marks': [sink.mark() for sink in self.sinks + self.event_sinks + self.metrics_sinks],
+                **self.adaptive_state(), **self.rest_state()}
+
+    def adaptive_state(self):
+        if self.controller is None:
+            return {}
+        return {'clock': self.clock, 'segment_time': self.segment[0], 'segment_x': self.segment[1].copy(),
+                'segment_v': self.segment[2].copy(), 'segment_balls': self.segment[3], 'bounce_times': self.pending_bounces[0],
+                'bounce_edges': self.pending_bounces[1]}
+
+    def rest_state(self):
+        if self.active is None:
+            return {}
+        return {'active': self.active.copy()}
+
+    def restore(self, checkpoint):
+        """Carry on from a checkpoint (see checkpoint.load_checkpoint) of a run on the same board and dt"""
+        if checkpoint['board'] != board_key(self.polygon) or checkpoint['dt'] != self.dt:
+            raise ValueError("The checkpoint belongs to another board or time step")
+        if self.engine is not None:
+            raise ValueError("The event-driven engine cannot be restored from a checkpoint")
+        parallel = self.parallel
+        if parallel is not None:
+            parallel.close(self)
+        self.x = np.array(checkpoint['x'], self.dtype)
+        self.v = np.array(checkpoint['v'], self.dtype)
+        self.radii = np.array(checkpoint['radii'], self.dtype)
+        self.frame = checkpoint['frame']
+        self.wall_count = checkpoint['wall_count']
+        self.collision_count = checkpoint['collision_count']
+        self.rng.bit_generator.state = checkpoint['rng']
+        if self.controller is not None:
+            self.clock = checkpoint['clock']
+            self.segment = (checkpoint['segment_time'], np.array(checkpoint['segment_x'], self.dtype),
+                            np.array(checkpoint['segment_v'], self.dtype), np.array(checkpoint['segment_balls']))
+            self.pending_bounces = (np.array(checkpoint['bounce_times']), np.array(checkpoint['bounce_edges']))
+        if self.active is not None:
+            self.active = np.array(checkpoint['active'], np.int64)
+        self.num_intersections = np.zeros(self.x.shape[0], np.int32)
+        self.nearest_side = np.zeros(self.x.shape[0], np.int32)
+        self.collision_grid = CollisionGrid(self.radii) if self.collisions else None
+        if parallel is not None:
+            self.parallel = ParallelStepper(self, parallel.workers)
+
+    def profile(self, enabled=True, interval=None, stream=None):
+        """Start a new Profiler (or stop profiling) and return it, profiling is off until then"""
+        self.profiler = Profiler(interval, stream) if enabled else NULL_PROFILER
+        return self.profiler
+
+    def step(self, n=1):
+        """Advance n frames of dt, writing each one to the sinks"""
+        profiler = self.profiler
+        if self.controller is not None:
+            self.step_adaptive(n)
+            return
+        if self.engine is not None:
+            profiler.start()
+            # The trajectories are exact, so frames can be sampled at any rate
+            times = self.dt * np.arange(self.frame + 1, self.frame + n + 1)
+            self.engine.run(times[-1])
+            profiler.lap('events')
+            frames, records = self.engine.sample(times)
+            hits = None
+            if self.event_sinks or self.metrics_sinks:
+                # Frame k takes the events up to and including time k * dt
+                frame = self.frame + 1 + np.searchsorted(times, records[:, 1])
+                self.log_events(records[:, 0].astype(np.int64), frame, records[:, 1], records[:, 6], records[:, 7],
+                                records[:, 2:4], records[:, 4:6])
+                walls = records[:, 6] == WALL
+                hits = np.zeros((n, self.polygon.shape[0]), np.int64)
+                np.add.at(hits, (frame[walls] - self.frame - 1, records[walls, 7].astype(np.int64)), 1)
+            profiler.count('wall_bounces', self.engine.wall_count - self.wall_count)
+            profiler.count('contacts', self.engine.contact_count - self.collision_count)
+            self.wall_count = self.engine.wall_count
+            self.collision_count = self.engine.contact_count
+            profiler.lap('sample')
+            for k, frame in enumerate(frames):
+                self.x[:] = frame[:, :2]
+                self.v[:] = frame[:, 2:]
+                if hits is not None:
+                    self.edge_hits = hits[k]
+                self.frame += 1
+                self.emit()
+                profiler.lap('output')
+                profiler.frame()
+            return
+        if self.parallel is not None:
+            for _ in range(n):
+                profiler.start()
+                walls, contacts, self.edge_hits = self.parallel.step()
+                self.wall_count += walls
+                self.collision_count += contacts
+                profiler.count('wall_bounces', walls)
+                profiler.count('contacts', contacts)
+                profiler.lap('parallel')
+                self.end_frame()
+            return
+        for _ in range(n):
+            profiler.start()
+            active = self.active
+            if active is None:
+                x, v, num_intersections, nearest_side = self.x, self.v, self.num_intersections, self.nearest_side
+            else:
+                # Only the moving balls are stepped, on compact copies written back once they have bounced
+                x, v = self.x[active], self.v[active]
+                num_intersections = self.num_intersections[:len(active)]
+                nearest_side = self.nearest_side[:len(active)]
+            if self.swept:
+                bounces = self.swept_walls.advance(x, v, self.dt, states=bool(self.event_sinks))
+                bounced = bounces[0]
+                v *= self.mu
+                if self.event_sinks:
+                    self.log_events(bounced, self.frame + 1, (self.frame + bounces[2]) * self.dt, WALL, bounces[1],
+                                    bounces[3], bounces[4])
+                    # Balls held at a wall by max_bounces only move on from the end of the frame
+                    stopped = bounces[5]
+                    self.log_events(stopped, self.frame + 1, (self.frame + 1) * self.dt, WALL, -1, self.x[stopped],
+                                    self.v[stopped])
+                if self.metrics_sinks:
+                    self.edge_hits = np.bincount(bounces[1], minlength=self.polygon.shape[0])
+                profiler.lap('walls')
+            else:
+                x += v * self.dt
+                v *= self.mu
+                profiler.lap('integrate')
+                self.edge_kernel(x, num_intersections, nearest_side)
+                profiler.lap('edges')
+                bounced = reflect_walls(v, num_intersections, nearest_side, self.normals)
+                if self.event_sinks:
+                    self.log_events(bounced, self.frame + 1, (self.frame + 1) * self.dt, WALL,
+                                    self.nearest_side[bounced], self.x[bounced], self.v[bounced])
+                if self.metrics_sinks:
+                    self.edge_hits = np.bincount(nearest_side[bounced], minlength=self.polygon.shape[0])
+                profiler.lap('reflect')
+            if active is not None:
+                self.x[active] = x
+                self.v[active] = v
+            self.wall_count += len(bounced)
+            profiler.count('wall_bounces', len(bounced))
+            if self.collisions:
+                i, j = self.collision_grid.resolve(self.x, self.v) if active is None else self.resolve_moving()
+                self.collision_count += len(i)
+                profiler.count('contacts', len(i))
+                if self.event_sinks:
+                    # Logged after all the contacts of the frame, so every record holds the final state
+                    balls = np.concatenate((i, j))
+                    self.log_events(balls, self.frame + 1, (self.frame + 1) * self.dt, CONTACT, np.concatenate((j, i)),
+                                    self.x[balls], self.v[balls])
+                profiler.lap('collisions')
+            if active is not None:
+                self.settle()
+                profiler.lap('rest')
+            self.end_frame()
+
+    def resolve_moving(self):
+        """Contacts that involve a moving ball
+
+        A contact reflects each ball's own velocity and passes nothing on to the other, so a resting ball that is hit
+        is only pushed out of the overlap and stays at rest, as a ball that slow would in a run without rest_speed.
+        It is not stepped again. Two resting balls never push each other apart, they stay where they stopped."""
+        moving = np.zeros(self.x.shape[0], bool)
+        moving[self.active] = True
+        i, j = self.collision_grid.candidate_pairs(self.x)
+        keep = moving[i] | moving[j]
+        i, j = resolve_collisions(self.x, self.v, self.collision_grid.radii_sq, i[keep], j[keep])
+        touched = np.concatenate((i, j))
+        self.profiler.count('pushed_at_rest', int(np.count_nonzero(~moving[touched])))
+        return i, j
+
+    def settle(self):
+        """Stop the moving balls slower than rest_speed
+
+        With speeds shrinking by mu every frame, a ball stopped at speed s had s * dt * mu / (1 - mu) left to
+        travel."""
+        v = self.v[self.active]
+        resting = np.sum(np.square(v, dtype=np.float64), axis=1) < self.rest_speed ** 2
+        if resting.any():
+            self.v[self.active[resting]] = 0
+            self.active = self.active[~resting]
+            self.profiler.count('stopped', int(np.count_nonzero(resting)))
+        self.profiler.gauge('moving_balls', self.active.shape[0])
+
+    def step_adaptive(self, n):
+        """Frames every dt from steps of the size the controller picks, with walls always swept so long steps never
+        overshoot
+
+        x and v are the state at clock, which runs ahead of the frames: each frame is placed on the path of the step
+        that covers it (see frame_state)."""
+        end = self.frame + n
+        while self.frame < end:
+            self.profiler.start()
+            time = (self.frame + 1) * self.dt
+            if time > self.clock:
+                self.advance_adaptive()
+                continue
+            x, v = self.frame_state(time)
+            times, edges = self.pending_bounces
+            due = times <= time
+            self.edge_hits = np.bincount(edges[due], minlength=self.polygon.shape[0])
+            self.pending_bounces = times[~due], edges[~due]
+            self.end_frame(x, v)
+
+    def frame_state(self, time):
+        """Positions and velocities at a time the last adaptive step covers"""
+        # Balls move in straight lines between bounces, the ones that bounced are stepped again up to the time
+        start, x0, v0, balls = self.segment
+        mean, final = damping(self.mu, time - start, self.dt)
+        x = x0 + v0 * (mean * (time - start))
+        v = v0 * final
+        xb, vb = x0[balls], v0[balls] * mean
+        self.swept_walls.advance(xb, vb, time - start)
+        x[balls] = xb
+        v[balls] = vb * (final / mean)
+        return x, v
+
+    def advance_adaptive(self):
+        """One step of the size the controller picks, halved until it agrees with two half steps (see adaptive)"""
+        controller = self.controller
+        x, v = self.x.copy(), self.v.copy()
+        h = controller.step_size(v)
+        while True:
+            bounced, edges, fractions, contacts = self.take_step(self.x, self.v, h)
+            half_x = None
+            if self.collisions:
+                half_x, half_v = x.copy(), v.copy()
+                self.take_step(half_x, half_v, h / 2)
+                self.take_step(half_x, half_v, h / 2)
+            if controller.accept(self.x, half_x, h):
+                break
+            self.x[:] = x
+            self.v[:] = v
+            h /= 2
+        self.segment = (self.clock, x, v, np.unique(bounced))
+        self.clock += h
+        self.wall_count += len(bounced)
+        self.collision_count += contacts
+        self.profiler.count('wall_bounces', len(bounced))
+        self.profiler.count('contacts', contacts)
+        self.profiler.count('steps')
+        if self.metrics_sinks:
+            self.pending_bounces = (np.concatenate((self.pending_bounces[0], self.segment[0] + fractions * h)),
+                                    np.concatenate((self.pending_bounces[1], edges)))
+        self.profiler.lap('adaptive')
+
+    def take_step(self, x, v, h):
+        """Step x and v in place by h, returns the bounces (ball, edge, time as a fraction of h) and the contacts"""
+        mean, final = damping(self.mu, h, self.dt)
+        v *= mean
+        bounced, edges, fractions = self.swept_walls.advance(x, v, h)
+        v *= final / mean
+        contacts = len(self.collision_grid.resolve(x, v)[0]) if self.collisions else 0
+        return bounced, edges, fractions, contacts
+
+    def end_frame(self, x=None, v=None):
+        self.frame += 1
+        self.emit(x, v)
+        self.profiler.lap('output')
+        if self.checkpointer is not None and self.frame % self.checkpointer.interval == 0:
+            self.checkpoint()
+            self.profiler.lap('checkpoint')
+        self.profiler.frame()
+
+    def emit(self, x=None, v=None):
+        """Hand the frame to the sinks, x and v default to the current state"""
+        x = self.x if x is None else x
+        v = self.v if v is None else v
+        for sink in self.sinks:
+            sink.write_frame(x, v, self.radii)
+        for sink in self.metrics_sinks:
+            sink.write_metrics(self.frame, self.frame * self.dt, x, v, self.edge_hits)
+        if self.profiler.enabled:
+            self.profiler.gauge('bytes_written', sum(getattr(sink, 'bytes_written', 0)
+                                                     for sink in self.sinks + self.event_sinks + self.metrics_sinks))
+
+    def state(self):
+        """Copy of the state at the last frame (x and v run ahead of it with adaptive steps)"""
+        if self.controller is not None:
+            x, v = self.frame_state(self.frame * self.dt)
         else:
-            x_isect = -(Cs[i] + Bs[i] * x[:, 1]) / As[i]
-            num_intersections += (lower[i] < x[:, 1]) & (x[:, 1] < upper[i]) & (x_isect < x[:, 0])
-            #crossed = ((xprev[:, 0] < x_isect) & (x_isect < x[:, 0])) | ((x[:, 0] < x_isect) & (x_isect < xprev[:, 0]))
-            proximity_to_line = As[i] * x[:, 0] + Bs[i] * x[:, 1] + Cs[i]
-            #print(i, proximity_to_line)
-            improved = proximity_to_line > closest
-            nearest_side[improved] = i
-            closest[improved] = proximity_to_line[improved]
-    #xprev = x.copy()
-    new_v = v - 2*(v[:, 0] * normals[:, 0][nearest_side] + v[:, 1] * normals[:, 1][nearest_side])[:, None] * normals[nearest_side]
-    #x[num_intersections % 2 == 0] = xprev[num_intersections % 2 == 0]
-    v[num_intersections % 2 == 0] = new_v[num_intersections % 2 == 0]
-    if collisions:
-        for i in range(NUM_BALLS):
-            for j in range(i+1, NUM_BALLS):
-                dx = x[i][0] - x[j][0]
-                dy = x[i][1] - x[j][1]
-                normal = np.array([dx, dy])
-                if magnitude_sq(normal) < (radii_sq[i] + radii_sq[j]):
-                    #find the average of centers
-                    average = np.array([(x[i][0] + x[j][0])/2, (x[i][1] + x[j][1])/2])
-                    #move each ball so that it no longer intersects
-                    normal = np.array([dx, dy])
-                    x[i] += normal * (radii_sq[i] + radii_sq[j] - magnitude_sq(normal))/2
-                    x[j] -= normal * (radii_sq[i] + radii_sq[j] - magnitude_sq(normal))/2
-                    #get component in normal direction
-                    towards_i = np.dot(v[i], normal)
-                    v[i] -= 2*towards_i * normal / magnitude_sq(normal)
-                    towards_j = np.dot(v[j], normal)
-                    v[j] -= 2*towards_j * normal / magnitude_sq(normal)
-    for i in range(NUM_BALLS):
-        file.write(f"{(x[i][0] - BOUNDS[0])/SIZE[0]} {(x[i][1] - BOUNDS[2])/SIZE[1]} {v[i][0]} {v[i][1]} {radii[i]*30} ")
-    file.write("\n")
-
-file.close()
+            x, v = self.x.copy(), self.v.copy()
+        return {'x': x, 'v': v, 'radii': self.radii.copy(), 'frame': self.frame, 'time': self.frame * self.dt,
+                'wall_count': self.wall_count, 'collision_count': self.collision_count}
+
+    def close(self):
+        """Close every sink, which flushes any frames still queued, wait for the queued checkpoints and stop the
+        stepping workers"""
+        for sink in self.sinks + self.event_sinks + self.metrics_sinks:
+            sink.close()
+        self.sinks = []
+        self.event_sinks = []
+        self.metrics_sinks = []
+        if self.checkpointer is not None:
+            self.checkpointer.close()
+            self.checkpointer = None
+        if self.parallel is not None:
+            self.parallel.close(self)
+            self.parallel = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    simulation = Simulation(polygon)
+    # Sink offsets in the order the sinks are added, None for fresh files
+    offsets = iter(())
+    resumed = CHECKPOINT_PATH is not None and os.path.exists(CHECKPOINT_PATH)
+    if resumed:
+        checkpoint = load_checkpoint(CHECKPOINT_PATH)
+        simulation.restore(checkpoint)
+        offsets = iter(checkpoint['offsets'].tolist())
+        print(f"Resuming from frame {simulation.frame}")
+    sinks = []
+    if OUTPUT_PATH is not None and OUTPUT_FORMAT == 'archive':
+        sinks.append(simulation.add_sink(open_archive(OUTPUT_PATH, polygon, NUM_BALLS, background=BACKGROUND_OUTPUT,
+                                                      offset=next(offsets, None))))
+    elif OUTPUT_PATH is not None:
+        sinks.append(simulation.add_sink(open_writer(OUTPUT_PATH, polygon, NUM_BALLS, OUTPUT_FORMAT, DTYPE,
+                                                     background=BACKGROUND_OUTPUT, offset=next(offsets, None))))
+    if EVENT_LOG_PATH is not None:
+        sinks.append(simulation.add_event_sink(EventLogWriter(EVENT_LOG_PATH, polygon, simulation.radii, dt,
+                                                              next(offsets, None)), start=not resumed))
+    if METRICS_PATH is not None:
+        sinks.append(simulation.add_metrics_sink(MetricsWriter(METRICS_PATH, polygon, NUM_BALLS, dt,
+                                                               offset=next(offsets, None))))
+    if CHECKPOINT_PATH is not None:
+        simulation.checkpoint_every(CHECKPOINT_PATH, CHECKPOINT_INTERVAL)
+    if PROFILE:
+        simulation.profile(interval=PROFILE_INTERVAL)
+    # Closing flushes every queued frame, even when the run is interrupted
+    with simulation:
+        simulation.step(FRAMES - simulation.frame)
+        if CHECKPOINT_PATH is not None and simulation.frame % CHECKPOINT_INTERVAL != 0:
+            simulation.checkpoint()
+    if PROFILE:
+        # Closing the sinks flushed everything, so the byte count is final
+        simulation.profiler.gauge('bytes_written', sum(sink.bytes_written for sink in sinks))
+        print(simulation.profiler.summary())
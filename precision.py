@@ -0,0 +1,77 @@
+import argparse
+
+import numpy as np
+
+from adaptive import kinetic_energy
+from physics import Simulation
+from trajectory import board_bounds
+
+PIXEL = 1 / 1000  # screen precision, as a fraction of the board size
+ENERGY_TOLERANCE = 1e-4  # relative kinetic energy drift accepted over the run
+
+
+def drift(polygon, num_balls=100, frames=1200, dtype=np.float32, pixel=PIXEL, energy_tolerance=ENERGY_TOLERANCE,
+          rng=0, **options):
+    """Step the same start in dtype and in float64 side by side and measure how far the cheap run strays
+
+    Both runs start from the float64 state rounded to dtype, so only the stepping differs. Frames are compared in
+    the viewer's coordinates (positions normalized to the board): the run is safe for this board and dt when no ball
+    is ever off by more than pixel and the kinetic energy stays within energy_tolerance of the float64 run's. Options
+    go to both Simulations (dt, collisions, radius, ...)."""
+    polygon = np.asarray(polygon, np.float64)
+    _, size = board_bounds(polygon)
+    scale = 1 / np.array(size)
+    options.update(board_cache=options.get('board_cache'), rng=rng)
+    cheap = Simulation(polygon, num_balls, dtype=dtype, **options)
+    reference = Simulation(polygon, num_balls, dtype=np.float64, **options)
+    reference.x[:] = cheap.x
+    reference.v[:] = cheap.v
+    reference.radii[:] = cheap.radii
+
+    errors = np.empty(frames)
+    stray = np.empty(frames)
+    energy = np.empty(frames)
+    for frame in range(frames):
+        cheap.step()
+        reference.step()
+        # The frames, which adaptive runs interpolate behind their own state
+        cheap_state, reference_state = cheap.state(), reference.state()
+        error = np.max(np.abs(cheap_state['x'] - reference_state['x']) * scale, axis=1)
+        errors[frame] = error.max()
+        stray[frame] = np.mean(error > pixel)
+        energy[frame] = kinetic_energy(cheap_state['v']) / kinetic_energy(reference_state['v']) - 1
+
+    diverged = np.flatnonzero(errors > pixel)
+    first = int(diverged[0]) + 1 if diverged.shape[0] else None
+    energy_drift = float(np.max(np.abs(energy)))
+    return {'dtype': np.dtype(dtype).name, 'frames': frames, 'balls': num_balls,
+            'max_error': float(errors.max()), 'first_diverged_frame': first, 'stray_fraction': float(stray[-1]),
+            'energy_drift': energy_drift,
+            'wall_bounces': (cheap.wall_count, reference.wall_count),
+            'contacts': (cheap.collision_count, reference.collision_count),
+            'safe': first is None and energy_drift < energy_tolerance,
+            'errors': errors, 'energy': energy}
+
+
+if __name__ == "__main__":
+    import physics
+    parser = argparse.ArgumentParser(description="Compare a float32 run of the physics.py board against float64")
+    parser.add_argument('--balls', type=int, default=physics.NUM_BALLS)
+    parser.add_argument('--frames', type=int, default=physics.FRAMES)
+    parser.add_argument('--dt', type=float, default=physics.dt)
+    parser.add_argument('--collisions', action='store_true')
+    parser.add_argument('--pixel', type=float, default=PIXEL)
+    args = parser.parse_args()
+
+    report = drift(physics.polygon, args.balls, args.frames, pixel=args.pixel, dt=args.dt,
+                   collisions=args.collisions)
+    print(f"{report['dtype']}: largest error {report['max_error']:.3g} of the board, "
+          f"energy drift {report['energy_drift']:.3g}")
+    if report['first_diverged_frame'] is None:
+        print(f"no ball strayed by more than {args.pixel:g} in {report['frames']} frames")
+    else:
+        print(f"balls strayed by more than {args.pixel:g} from frame {report['first_diverged_frame']}, "
+              f"{report['stray_fraction']:.1%} of them by the end")
+    print(f"wall bounces {report['wall_bounces'][0]} vs {report['wall_bounces'][1]}, "
+          f"contacts {report['contacts'][0]} vs {report['contacts'][1]}")
+    print("float32 is safe for this board and dt" if report['safe'] else "stay with float64 for this board and dt")
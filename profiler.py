@@ -0,0 +1,86 @@
+import json
+import sys
+import time
+
+
+class Profiler:
+    """Cumulative time per phase of the step loop and event counters
+
+    Phases are timed as laps: lap(name) charges the time since the previous lap (or start) to that phase, so a frame
+    costs one clock read per phase. With interval set, a JSON line with the totals so far goes to stream every
+    interval frames."""
+    enabled = True
+
+    def __init__(self, interval=None, stream=None):
+        self.interval = interval
+        self.stream = stream
+        self.phases = {}
+        self.counters = {}
+        self.frames = 0
+        self.created = time.perf_counter()
+        self.last = self.created
+
+    def start(self):
+        self.last = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self.last
+        self.last = now
+
+    def count(self, counter, amount=1):
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def gauge(self, counter, value):
+        self.counters[counter] = value
+
+    def frame(self):
+        self.frames += 1
+        if self.interval and self.frames % self.interval == 0:
+            self.emit()
+
+    def report(self):
+        timed = sum(self.phases.values())
+        return {'frames': self.frames, 'elapsed': time.perf_counter() - self.created, 'timed': timed,
+                'phases': {phase: {'seconds': seconds, 'share': seconds / timed if timed else 0.0,
+                                   'per_frame': seconds / self.frames if self.frames else 0.0}
+                           for phase, seconds in self.phases.items()},
+                'counters': dict(self.counters)}
+
+    def emit(self):
+        stream = self.stream or sys.stderr
+        stream.write(json.dumps(self.report()) + "\n")
+        stream.flush()
+
+    def summary(self):
+        report = self.report()
+        lines = [f"{report['frames']} frames in {report['elapsed']:.3f} s"]
+        for phase, timing in sorted(report['phases'].items(), key=lambda item: -item[1]['seconds']):
+            lines.append(f"  {phase:<12} {timing['seconds']:9.4f} s  {timing['share']:6.1%}"
+                         f"  {timing['per_frame'] * 1e6:10.1f} us/frame")
+        for counter, value in report['counters'].items():
+            lines.append(f"  {counter:<12} {value}")
+        return "\n".join(lines)
+
+
+class NullProfiler:
+    """Stands in for Profiler when profiling is off, every call is a no-op"""
+    enabled = False
+
+    def start(self):
+        pass
+
+    def lap(self, phase):
+        pass
+
+    def count(self, counter, amount=1):
+        pass
+
+    def gauge(self, counter, value):
+        pass
+
+    def frame(self):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
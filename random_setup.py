@@ -52,9 +52,10 @@ def save_to_file(_board, _frames, filename='data.txt'):
             frame_str = ' '.join([' '.join(map(str, ball)) for ball in frame])
             file.write(frame_str + '\n')
 
-board = random_board()
-frames.append(initialize_frame())
-for _ in range(NUM_FRAMES - 1):
-    frames.append(new_frame(frames[-1]))
+if __name__ == "__main__":
+    board = random_board()
+    frames.append(initialize_frame())
+    for _ in range(NUM_FRAMES - 1):
+        frames.append(new_frame(frames[-1]))
 
-save_to_file(board, frames)
+    save_to_file(board, frames)
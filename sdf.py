@@ -0,0 +1,152 @@
+import numpy as np
+
+from edge_index import EdgeIndex
+from kernels import EdgeKernel
+
+INSIDE = -1
+UNKNOWN = -2
+
+
+def segment_distance(px, py, polygon, chunk_size=4096):
+    """Distance from every point to the nearest edge of the board"""
+    starts = polygon[:, 0:2]
+    directions = polygon[:, 2:4] - starts
+    lengths = np.maximum(directions[:, 0] ** 2 + directions[:, 1] ** 2, np.finfo(np.float64).tiny)
+    distance = np.empty(px.shape[0])
+    for start in range(0, px.shape[0], chunk_size):
+        stop = min(start + chunk_size, px.shape[0])
+        qx = px[start:stop, None] - starts[:, 0]
+        qy = py[start:stop, None] - starts[:, 1]
+        s = np.clip((qx * directions[:, 0] + qy * directions[:, 1]) / lengths, 0, 1)
+        dx = qx - s * directions[:, 0]
+        dy = qy - s * directions[:, 1]
+        distance[start:stop] = np.sqrt(np.min(dx * dx + dy * dy, axis=1))
+    return distance
+
+
+class DistanceField:
+    """Signed distance to the walls sampled on a grid, with the containment and nearest side of every cell where they
+    hold for the whole cell, a drop-in replacement for EdgeKernel
+
+    A ball in such a cell is resolved by one gather. Balls in cells a wall runs through, in cells where the nearest
+    side changes, off the grid or level with a vertex (where the crossing count of the ray test is degenerate) go
+    through the exact EdgeIndex, so the parity and nearest side always match EdgeKernel. num_intersections only keeps
+    the parity for gathered balls, and nearest_side is 0 for balls inside, like EdgeIndex."""
+    def __init__(self, polygon, As, Bs, Cs, lower, upper, resolution=None, chunk_size=None, dtype=np.float64):
+        polygon = np.asarray(polygon, np.float64)
+        self.kernel = EdgeKernel(As, Bs, Cs, lower, upper, chunk_size=4096)
+        self.refine = EdgeIndex(polygon, As, Bs, Cs, lower, upper, chunk_size=chunk_size, dtype=dtype)
+        edges = polygon.shape[0]
+        if resolution is None:
+            resolution = max(64, int(np.ceil(16 * np.sqrt(edges))))
+
+        # One spare cell around the board catches balls that just left it
+        x0, x1 = np.min(polygon[:, ::2]), np.max(polygon[:, ::2])
+        y0, y1 = np.min(polygon[:, 1::2]), np.max(polygon[:, 1::2])
+        self.cell_size = max(x1 - x0, y1 - y0) / resolution
+        self.x0 = x0 - self.cell_size
+        self.y0 = y0 - self.cell_size
+        self.nx = int(np.ceil((x1 - x0) / self.cell_size)) + 2
+        self.ny = int(np.ceil((y1 - y0) / self.cell_size)) + 2
+        self.vertex_ys = np.unique(polygon[:, 1::2])
+
+        ix, iy = np.divmod(np.arange(self.nx * self.ny), self.ny)
+        cx = self.x0 + (ix + 0.5) * self.cell_size
+        cy = self.y0 + (iy + 0.5) * self.cell_size
+        # The ray test is degenerate level with a vertex, sample the parity a little off the centre there
+        level = np.isin(cy, self.vertex_ys)
+        cy_parity = np.where(level, cy + 0.25 * self.cell_size, cy)
+        count, _ = self.kernel(np.column_stack((cx, cy_parity)))
+        inside = count % 2 == 1
+        distance = segment_distance(cx, cy, polygon)
+        self.field = np.where(inside, -distance, distance)
+
+        # Cells no wall runs through have the same containment everywhere
+        clear = distance > 0.5 * np.sqrt(2) * self.cell_size * (1 + 1e-9)
+        self.cells = np.full(self.nx * self.ny, UNKNOWN, np.int32)
+        self.cells[clear & inside] = INSIDE
+        outside = np.flatnonzero(clear & ~inside)
+        self.cells[outside] = self.certified_sides(ix[outside], iy[outside])
+
+    def certified_sides(self, ix, iy, chunk_size=4096):
+        """Nearest side of each cell where it is the same all over the cell, UNKNOWN elsewhere
+
+        The points where a given edge is the first maximum of A x + B y + C form a convex region (and the maximum
+        itself is convex), so a side winning at all four corners by some margin wins in the whole cell, and a maximum
+        below zero at the four corners stays below zero inside."""
+        kernel = self.kernel
+        reach = (max(self.nx, self.ny) + 1) * self.cell_size + abs(self.x0) + abs(self.y0)
+        margin = 1e-9 * ((np.max(np.abs(kernel.As)) + np.max(np.abs(kernel.Bs))) * reach + np.max(np.abs(kernel.Cs)))
+        sides = np.full(ix.shape[0], UNKNOWN, np.int64)
+        for start in range(0, ix.shape[0], chunk_size):
+            stop = min(start + chunk_size, ix.shape[0])
+            rows = np.arange(stop - start)
+            winner = None
+            agree = np.ones(stop - start, bool)
+            negative = np.ones(stop - start, bool)
+            for corner_x, corner_y in ((0, 0), (1, 0), (0, 1), (1, 1)):
+                px = self.x0 + (ix[start:stop, None] + corner_x) * self.cell_size
+                py = self.y0 + (iy[start:stop, None] + corner_y) * self.cell_size
+                work = kernel.As * px + kernel.Bs * py + kernel.Cs + kernel.bias
+                best = np.argmax(work, axis=1)
+                top = work[rows, best]
+                work[rows, best] = -np.inf
+                runner_up = np.max(work, axis=1)
+                winner = best if winner is None else winner
+                agree &= (best == winner) & (top > margin) & (top - runner_up > margin)
+                negative &= top < -margin
+            sides[start:stop][agree] = winner[agree]
+            sides[start:stop][negative] = 0
+        return sides
+
+    def arrays(self):
+        """Everything the field needs at run time, as arrays that can be saved and handed back to from_arrays"""
+        return {'grid': np.array([self.x0, self.y0, self.cell_size]), 'shape': np.array([self.nx, self.ny], np.int64),
+                'field': self.field, 'cells': self.cells, 'vertex_ys': self.vertex_ys}
+
+    @classmethod
+    def from_arrays(cls, refine, arrays):
+        """Rebuild a field around the given EdgeIndex without rasterizing the board again"""
+        field = cls.__new__(cls)
+        field.refine = refine
+        field.kernel = refine.kernel
+        field.x0, field.y0, field.cell_size = arrays['grid'].tolist()
+        field.nx, field.ny = arrays['shape'].tolist()
+        field.field = arrays['field']
+        field.cells = arrays['cells']
+        field.vertex_ys = arrays['vertex_ys']
+        return field
+
+    def cell(self, x):
+        """Cell of every ball, -1 off the grid"""
+        ix = np.floor((x[:, 0] - self.x0) / self.cell_size)
+        iy = np.floor((x[:, 1] - self.y0) / self.cell_size)
+        on_grid = (ix >= 0) & (ix < self.nx) & (iy >= 0) & (iy < self.ny)
+        return np.where(on_grid, ix * self.ny + iy, -1).astype(np.int64)
+
+    def distance(self, x):
+        """Signed distance to the walls (negative inside) at the centre of each ball's cell, inf off the grid"""
+        cell = self.cell(x)
+        return np.where(cell >= 0, self.field[cell], np.inf)
+
+    def __call__(self, x, num_intersections=None, nearest_side=None):
+        n = x.shape[0]
+        if num_intersections is None:
+            num_intersections = np.zeros(n, np.int32)
+        if nearest_side is None:
+            nearest_side = np.zeros(n, np.int32)
+
+        cell = self.cell(x)
+        code = np.where(cell >= 0, self.cells[cell], UNKNOWN)
+        level = np.isin(x[:, 1], self.vertex_ys)
+        code[level] = UNKNOWN
+        num_intersections[:] = code == INSIDE
+        nearest_side[:] = np.maximum(code, 0)
+
+        # Exact refinement next to the walls
+        unknown = np.flatnonzero(code == UNKNOWN)
+        if unknown.shape[0] > 0:
+            count, side = self.refine(x[unknown])
+            num_intersections[unknown] = count
+            nearest_side[unknown] = side
+        return num_intersections, nearest_side
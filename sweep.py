@@ -0,0 +1,119 @@
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from board_cache import CACHE_DIR, compiled_board
+from ensemble import run_ensemble
+
+PARAMETERS = ('board', 'num_balls', 'frames', 'dt', 'mu', 'epsilon', 'collisions', 'seed')
+DEFAULTS = {'num_balls': 100, 'frames': 1200, 'dt': 0.0025, 'mu': 1, 'epsilon': -0.2, 'collisions': False, 'seed': 0}
+METRICS = ('wall_bounces', 'contacts', 'mean_speed', 'center_x', 'center_y', 'seconds')
+COLUMNS = ('key', 'status') + PARAMETERS + METRICS + ('output', 'error')
+
+SQUARE = np.array([[0, 0, 1, 0], [1, 0, 1, 1], [1, 1, 0, 1], [0, 1, 0, 0]], np.float64)
+
+# Boards of the current worker process, sent once by the pool initializer instead of with every point
+worker_boards = {}
+
+
+def parameter_grid(**axes):
+    """Every combination of the given values, missing parameters take their DEFAULTS"""
+    names = list(axes)
+    return [{**DEFAULTS, **dict(zip(names, values))} for values in itertools.product(*(axes[name] for name in names))]
+
+
+def point_key(point):
+    return json.dumps({name: point.get(name) for name in PARAMETERS}, sort_keys=True)
+
+
+def load_board(path):
+    """Board exported by PolygonCreator: x1 y1 x2 y2 for every side on one line"""
+    with open(path) as file:
+        return np.array(file.read().split(), np.float64).reshape(-1, 4)
+
+
+def init_worker(boards):
+    worker_boards.update(boards)
+
+
+def run_point(point, output_dir=None, board_cache=None):
+    output = None
+    if output_dir is not None:
+        name = '_'.join(f"{name}-{point[name]}" for name in PARAMETERS)
+        output = os.path.join(output_dir, f"{name}.traj")
+    start = time.perf_counter()
+    try:
+        result = run_ensemble(worker_boards[point['board']], 1, point['num_balls'], point['frames'], point['dt'],
+                              point['mu'], point['epsilon'], collisions=point['collisions'], seed=point['seed'],
+                              output=output, board_cache=board_cache)
+    except Exception as error:
+        return {**point, 'status': 'failed', 'error': repr(error), 'output': output}
+    x = result['x'][0]
+    v = result['v'][0]
+    return {**point, 'status': 'done', 'output': output,
+            'wall_bounces': int(result['wall_bounces'][0]), 'contacts': int(result['contacts'][0]),
+            'mean_speed': float(np.mean(np.sqrt(v[:, 0] ** 2 + v[:, 1] ** 2))),
+            'center_x': float(x[:, 0].mean()), 'center_y': float(x[:, 1].mean()),
+            'seconds': time.perf_counter() - start}
+
+
+def load_results(path):
+    """Latest row of every point already in the results table"""
+    results = {}
+    if os.path.exists(path):
+        with open(path, newline='') as file:
+            for row in csv.DictReader(file):
+                results[row['key']] = row
+    return results
+
+
+def run_sweep(grid, boards, results_path='sweep_results.csv', output_dir=None, workers=None, retry_failed=False,
+              board_cache=CACHE_DIR):
+    """Run every point of the grid on a process pool, appending one row per finished point to results_path
+
+    Points already recorded as done (or failed, unless retry_failed) are skipped, so an interrupted sweep resumes
+    where it stopped. Boards are compiled into board_cache once, up front, and every run loads them from there."""
+    previous = load_results(results_path)
+    skip = ('done',) if retry_failed else ('done', 'failed')
+    todo = [point for point in grid if previous.get(point_key(point), {}).get('status') not in skip]
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    if board_cache is not None:
+        for polygon in boards.values():
+            compiled_board(polygon, board_cache)
+
+    new_file = not os.path.exists(results_path)
+    with open(results_path, 'a', newline='') as file:
+        table = csv.DictWriter(file, COLUMNS, extrasaction='ignore')
+        if new_file:
+            table.writeheader()
+        with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(boards,)) as pool:
+            futures = {pool.submit(run_point, point, output_dir, board_cache): point for point in todo}
+            for future in as_completed(futures):
+                point = futures[future]
+                try:
+                    row = future.result()
+                except Exception as error:
+                    # The worker process died (killed, out of memory, ...) and took the pool down, so this point may
+                    # never have started: it is not skipped on resume
+                    row = {**point, 'status': 'crashed', 'error': repr(error)}
+                row['key'] = point_key(point)
+                table.writerow(row)
+                file.flush()
+                print(f"{row['status']}: {row['key']}")
+    return load_results(results_path)
+
+
+if __name__ == "__main__":
+    # python sweep.py [board.txt ...]
+    boards = {'square': SQUARE}
+    for path in sys.argv[1:]:
+        boards[os.path.splitext(os.path.basename(path))[0]] = load_board(path)
+    grid = parameter_grid(board=list(boards), mu=[1, 0.999], num_balls=[10, 100], seed=range(4))
+    run_sweep(grid, boards, output_dir='sweep_output')
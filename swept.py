@@ -0,0 +1,85 @@
+import numpy as np
+
+
+class SweptWalls:
+    """Continuous wall collision: each step is swept against the edges and bounced at the exact crossing point"""
+    def __init__(self, polygon, normals, max_bounces=16, chunk_size=None):
+        self.starts = np.ascontiguousarray(polygon[:, 0:2], np.float64)
+        self.directions = np.ascontiguousarray(polygon[:, 2:4] - polygon[:, 0:2], np.float64)
+        self.normals = np.asarray(normals, np.float64)
+        self.max_bounces = max_bounces
+        self.chunk_size = chunk_size
+
+    def first_hit(self, p, d, exclude, limit=1):
+        """Fraction of the move p -> p + d at which each ball first crosses an edge, and that edge (-1 if none)
+
+        Crossings further than limit moves away are ignored."""
+        m = p.shape[0]
+        hit_time = np.full(m, np.inf)
+        hit_edge = np.full(m, -1, np.int64)
+        step = self.chunk_size or m
+        ex = self.directions[:, 0]
+        ey = self.directions[:, 1]
+        for start in range(0, m, max(step, 1)):
+            stop = min(start + step, m)
+            dx = d[start:stop, 0:1]
+            dy = d[start:stop, 1:2]
+            qx = self.starts[:, 0] - p[start:stop, 0:1]
+            qy = self.starts[:, 1] - p[start:stop, 1:2]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                denom = dx * ey - dy * ex
+                t = (qx * ey - qy * ex) / denom
+                s = (qx * dy - qy * dx) / denom
+            valid = (denom != 0) & (t > 0) & (t <= limit) & (s >= 0) & (s <= 1)
+            # The edge a ball just bounced off sits at t = 0 and must not catch it again
+            rows = np.arange(stop - start)
+            previous = exclude[start:stop]
+            valid[rows[previous >= 0], previous[previous >= 0]] = False
+            t[~valid] = np.inf
+            edge = np.argmin(t, axis=1)
+            hit_time[start:stop] = t[rows, edge]
+            hit_edge[start:stop] = np.where(np.isfinite(hit_time[start:stop]), edge, -1)
+        return hit_time, hit_edge
+
+    def advance(self, x, v, dt, states=False):
+        """Move every ball by v * dt in place, reflecting v off each edge it crosses on the way
+
+        Returns the (ball, edge, time) of every bounce, with times as fractions of dt. When states is set, the
+        position and velocity right after each bounce follow, then the balls stopped by max_bounces."""
+        remaining = np.ones(x.shape[0])
+        moving = np.arange(x.shape[0])
+        exclude = np.full(x.shape[0], -1, np.int64)
+        balls, edges, times, points, velocities = [], [], [], [], []
+        stopped = np.zeros(0, np.int64)
+        for _ in range(self.max_bounces):
+            d = v[moving] * (dt * remaining[moving])[:, None]
+            hit_time, hit_edge = self.first_hit(x[moving], d, exclude[moving])
+            hit = hit_edge >= 0
+
+            # Balls with a clear path finish their move
+            free = moving[~hit]
+            x[free] += d[~hit]
+
+            moving, d, hit_time, hit_edge = moving[hit], d[hit], hit_time[hit], hit_edge[hit]
+            if moving.shape[0] == 0:
+                break
+            x[moving] += d * hit_time[:, None]
+            n = self.normals[hit_edge]
+            v[moving] -= 2 * (v[moving, 0] * n[:, 0] + v[moving, 1] * n[:, 1])[:, None] * n
+            balls.append(moving)
+            edges.append(hit_edge)
+            times.append(1 - remaining[moving] * (1 - hit_time))
+            if states:
+                points.append(x[moving])
+                velocities.append(v[moving])
+            remaining[moving] *= 1 - hit_time
+            exclude[moving] = hit_edge
+        else:
+            # Balls still bouncing after max_bounces stay at their last contact point rather than risk tunnelling
+            stopped = moving
+
+        if not balls:
+            bounces = np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0)
+            return bounces + (np.zeros((0, 2)), np.zeros((0, 2)), np.zeros(0, np.int64)) if states else bounces
+        bounces = np.concatenate(balls), np.concatenate(edges), np.concatenate(times)
+        return bounces + (np.concatenate(points), np.concatenate(velocities), stopped) if states else bounces
@@ -0,0 +1,311 @@
+import atexit
+import os
+import queue
+import struct
+import sys
+import threading
+
+import numpy as np
+
+# Binary trajectory layout (little endian):
+#   magic    8 bytes  b'BWTRAJ\0\0'
+#   header   '<HHII'  version, dtype code, number of edges, number of balls
+#   edges    edges x 4 float64, the board as written by physics.py
+#   frames   frames x balls x 5 (x, y, vx, vy, r) of the header dtype, contiguous up to the end of the file
+MAGIC = b'BWTRAJ\0\0'
+VERSION = 1
+HEADER = struct.Struct('<HHII')
+DTYPES = {0: np.dtype('<f8'), 1: np.dtype('<f4')}
+DTYPE_CODES = {dtype: code for code, dtype in DTYPES.items()}
+FIELDS = 5
+TEXT_DIGITS = {np.dtype('<f4'): 9}  # significant digits that round-trip the dtype, full repr when not listed
+
+
+class BoardFormat:
+    """How every binary output of a run starts: its magic, a struct header whose first field is the version and
+    whose edges_field-th field is the number of edges, then the board edges as float64"""
+    def __init__(self, name, magic, version, header, edges_field):
+        self.name = name
+        self.magic = magic
+        self.version = version
+        self.header = header
+        self.edges_field = edges_field
+
+    def write(self, file, polygon, *fields):
+        """Write the start of a new file, fields being the header after the version, returns the bytes written"""
+        file.write(self.magic)
+        file.write(self.header.pack(self.version, *fields))
+        file.write(np.asarray(polygon, '<f8').tobytes())
+        return file.tell()
+
+    def read(self, file):
+        """Header fields after the version and board edges (edges, 4), leaving file at what follows them"""
+        if file.read(len(self.magic)) != self.magic:
+            raise ValueError(f"Not a file in the {self.name} format")
+        version, *fields = self.header.unpack(file.read(self.header.size))
+        if version > self.version:
+            raise ValueError(f"The {self.name} format version {version} is newer than this reader ({self.version})")
+        num_edges = fields[self.edges_field - 1]
+        edges = np.frombuffer(file.read(num_edges * 4 * 8), '<f8').reshape(num_edges, 4)
+        return fields, edges
+
+    def matches(self, path):
+        with open(path, 'rb') as file:
+            return file.read(len(self.magic)) == self.magic
+
+
+FORMAT = BoardFormat('binary trajectory', MAGIC, VERSION, HEADER, edges_field=2)
+
+
+def read_records(file, dtype):
+    # A run killed mid-write can leave a partial record at the end, it is left out
+    data = file.read()
+    return np.frombuffer(data, dtype, len(data) // dtype.itemsize)
+
+
+def board_bounds(polygon):
+    bounds = np.min(polygon[:, ::2]), np.max(polygon[:, ::2]), np.min(polygon[:, 1::2]), np.max(polygon[:, 1::2])
+    return bounds, (bounds[1] - bounds[0], bounds[3] - bounds[2])
+
+
+def frame_records(x, v, radii, bounds, size, dtype=np.float64):
+    """(..., balls, 5) records as the viewer reads them: positions normalized to the board, radii scaled by 30"""
+    records = np.empty(x.shape[:-1] + (FIELDS,), dtype)
+    records[..., 0] = (x[..., 0] - bounds[0]) / size[0]
+    records[..., 1] = (x[..., 1] - bounds[2]) / size[1]
+    records[..., 2:4] = v
+    records[..., 4] = radii * 30
+    return records
+
+
+class Mark:
+    """Offset of the end of an output at some frame, known once everything before it reached the file"""
+    def __init__(self, offset=None):
+        self.offset = offset
+        self.error = None
+        self.done = threading.Event()
+        if offset is not None:
+            self.done.set()
+
+    def resolve(self, offset=None, error=None):
+        self.offset = offset
+        self.error = error
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.offset
+
+
+class OutputFile:
+    """A file a run appends to, created by open(path), which writes its header and counts it in bytes_written
+
+    With offset set, the file is an earlier output of the same run to append to from that offset instead (see
+    checkpoint): whatever was written after it is dropped."""
+    append_mode = 'ab'
+
+    def start(self, path, offset=None):
+        self.bytes_written = 0
+        if offset is None:
+            self.file = self.open(path)
+        else:
+            os.truncate(path, offset)
+            self.file = open(path, self.append_mode)
+            self.bytes_written = offset
+
+    def mark(self):
+        """Mark at the end of what was written so far, flushed to the file"""
+        self.file.flush()
+        return Mark(self.bytes_written)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TrajectoryWriter(OutputFile):
+    """Writes frames in bulk, straight from the state arrays"""
+    def __init__(self, path, polygon, num_balls, dtype=np.float64, offset=None):
+        self.polygon = np.asarray(polygon, np.float64)
+        self.num_balls = num_balls
+        self.dtype = np.dtype(dtype).newbyteorder('<')
+        self.bounds, self.size = board_bounds(self.polygon)
+        self.start(path, offset)
+
+    def records(self, x, v, radii):
+        return frame_records(x, v, radii, self.bounds, self.size, self.dtype)
+
+    def write_frame(self, x, v, radii):
+        self.write_frames(self.records(x, v, radii))
+
+
+class BinaryTrajectoryWriter(TrajectoryWriter):
+    def open(self, path):
+        file = open(path, 'wb')
+        self.bytes_written = FORMAT.write(file, self.polygon, DTYPE_CODES[self.dtype], self.polygon.shape[0],
+                                          self.num_balls)
+        return file
+
+    def write_frames(self, frames):
+        self.bytes_written += self.file.write(np.ascontiguousarray(frames, self.dtype).tobytes())
+
+
+class TextTrajectoryWriter(TrajectoryWriter):
+    """The original data.txt format: the board on the first line, then one line per frame"""
+    append_mode = 'a'
+
+    def open(self, path):
+        file = open(path, 'w')
+        self.bytes_written = file.write(''.join(f"{value} " for value in self.polygon.ravel().tolist()) + "\n")
+        return file
+
+    def write_frames(self, frames):
+        frames = np.asarray(frames, self.dtype).reshape(-1, self.num_balls * FIELDS)
+        digits = TEXT_DIGITS.get(self.dtype)
+        convert = str if digits is None else f"{{:.{digits}g}}".format
+        self.bytes_written += self.file.write(''.join(' '.join(map(convert, frame.tolist())) + " \n"
+                                                      for frame in frames))
+
+
+class AsyncWriter:
+    """Hands frame snapshots to a writer thread through a bounded queue and flushes them in large blocks
+
+    put blocks once max_pending snapshots are waiting, which caps memory when the disk is slower than the simulation."""
+    def __init__(self, writer, max_pending=256, block_frames=128):
+        self.writer = writer
+        self.block_frames = block_frames
+        self.pending = queue.Queue(max_pending)
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.drain, name='trajectory-writer', daemon=True)
+        self.thread.start()
+        # Interpreter exit (including an uncaught Ctrl-C) still flushes what was queued
+        atexit.register(self.close)
+
+    @property
+    def bytes_written(self):
+        # Only what the thread has written out so far, not what is still queued
+        return self.writer.bytes_written
+
+    def records(self, x, v, radii):
+        return self.writer.records(x, v, radii)
+
+    def write_frame(self, x, v, radii):
+        # records() builds a fresh array, so the caller is free to keep mutating x and v
+        self.put(self.writer.records(x, v, radii)[None])
+
+    def write_frames(self, frames):
+        self.put(np.array(frames, self.writer.dtype))
+
+    def mark(self):
+        """Mark resolved by the writer thread once every frame queued so far is written and flushed"""
+        mark = Mark()
+        self.put(mark)
+        return mark
+
+    def put(self, block):
+        if self.error is not None:
+            raise self.error
+        self.pending.put(block)
+
+    def drain(self):
+        done = False
+        while not done:
+            # Frame blocks up to block_frames, a mark or the closing None
+            blocks = []
+            count = 0
+            item = self.pending.get()
+            while isinstance(item, np.ndarray):
+                blocks.append(item)
+                count += item.shape[0]
+                item = False
+                if count < self.block_frames:
+                    try:
+                        item = self.pending.get_nowait()
+                    except queue.Empty:
+                        pass
+            done = item is None
+            if blocks and self.error is None:
+                try:
+                    self.writer.write_frames(np.concatenate(blocks))
+                except BaseException as error:
+                    # Keep consuming so the simulation does not block, the error surfaces on its next put
+                    self.error = error
+            if isinstance(item, Mark):
+                try:
+                    if self.error is not None:
+                        raise self.error
+                    item.resolve(self.writer.mark().offset)
+                except BaseException as error:
+                    item.resolve(error=error)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        atexit.unregister(self.close)
+        self.pending.put(None)
+        self.thread.join()
+        self.writer.close()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_writer(path, polygon, num_balls, output_format='binary', dtype=np.float64, background=False, offset=None):
+    if output_format == 'binary':
+        writer = BinaryTrajectoryWriter(path, polygon, num_balls, dtype, offset)
+    elif output_format == 'text':
+        writer = TextTrajectoryWriter(path, polygon, num_balls, dtype, offset)
+    else:
+        raise ValueError(f"Unknown output format: {output_format}")
+    return AsyncWriter(writer) if background else writer
+
+
+def is_binary(path):
+    return FORMAT.matches(path)
+
+
+def read_header(file):
+    (dtype_code, _, num_balls), edges = FORMAT.read(file)
+    return edges, DTYPES[dtype_code], num_balls
+
+
+def read_trajectory(path, mmap=False):
+    """Board edges (edges, 4) and frames (frames, balls, 5) of a binary trajectory"""
+    with open(path, 'rb') as file:
+        edges, dtype, num_balls = read_header(file)
+        offset = file.tell()
+        file.seek(0, 2)
+        frame_bytes = num_balls * FIELDS * dtype.itemsize
+        num_frames = (file.tell() - offset) // frame_bytes if frame_bytes else 0
+    if mmap and num_frames > 0:
+        frames = np.memmap(path, dtype, 'r', offset, (num_frames, num_balls, FIELDS))
+    else:
+        frames = np.fromfile(path, dtype, num_frames * num_balls * FIELDS, offset=offset).reshape(num_frames, num_balls, FIELDS)
+    return edges, frames
+
+
+def export_text(binary_path, text_path):
+    edges, frames = read_trajectory(binary_path, mmap=True)
+    writer = TextTrajectoryWriter(text_path, edges, frames.shape[1], frames.dtype)
+    for start in range(0, frames.shape[0], 256):
+        writer.write_frames(frames[start:start + 256])
+    writer.close()
+
+
+if __name__ == "__main__":
+    # python trajectory.py data.traj data.txt
+    export_text(sys.argv[1], sys.argv[2])
@@ -0,0 +1,367 @@
+import numpy as np
+
+from edge_index import EdgeIndex
+
+MAX_WALK = 64  # triangles a ball may cross in one call before the exact test takes over
+START_RESOLUTION = 32  # cells along the longer side of the grid the walks of new balls start from
+
+
+def outlines(polygon):
+    """Closed outlines of the board as (vertices, 2) arrays, following the edges whatever their direction"""
+    starts = list(map(tuple, polygon[:, 0:2].tolist()))
+    ends = list(map(tuple, polygon[:, 2:4].tolist()))
+    touching = {}
+    for e, (start, end) in enumerate(zip(starts, ends)):
+        touching.setdefault(start, []).append(e)
+        touching.setdefault(end, []).append(e)
+    if any(len(edges) != 2 for edges in touching.values()):
+        raise ValueError("Every vertex of a triangulated board must join exactly two edges")
+    used = np.zeros(polygon.shape[0], bool)
+    loops = []
+    for first in range(polygon.shape[0]):
+        e = first
+        point = starts[first]
+        loop = []
+        while not used[e]:
+            used[e] = True
+            loop.append(point)
+            point = ends[e] if starts[e] == point else starts[e]
+            e = next(f for f in touching[point] if f != e)
+        if loop:
+            loops.append(np.array(loop))
+    return loops
+
+
+def signed_area(loop):
+    following = np.roll(loop, -1, axis=0)
+    return 0.5 * np.sum(loop[:, 0] * following[:, 1] - following[:, 0] * loop[:, 1])
+
+
+def encloses(loop, point):
+    """Whether point is inside the closed outline loop (even-odd rule)"""
+    x0, y0 = loop[:, 0], loop[:, 1]
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+    straddling = (y0 > point[1]) != (y1 > point[1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossing = x0 + (point[1] - y0) * (x1 - x0) / (y1 - y0)
+    return np.count_nonzero(straddling & (crossing > point[0])) % 2 == 1
+
+
+def cross(o, a, b):
+    return (a[..., 0] - o[..., 0]) * (b[..., 1] - o[..., 1]) - (a[..., 1] - o[..., 1]) * (b[..., 0] - o[..., 0])
+
+
+def bridge(outer, hole):
+    """Join a clockwise hole to the counter-clockwise outline around it by a pair of coincident edges, so the two
+    can be clipped as one polygon
+
+    The bridge runs from the rightmost vertex of the hole to a vertex of the outline it can see (Eberly's
+    construction): the nearer end of the first edge to its right, or the reflex vertex at the smallest angle inside
+    the triangle between them."""
+    m = int(np.argmax(hole[:, 0]))
+    mx, my = hole[m]
+    following = np.roll(outer, -1, axis=0)
+    best, visible = np.inf, None
+    for i in range(outer.shape[0]):
+        (x0, y0), (x1, y1) = outer[i], following[i]
+        if min(y0, y1) > my or max(y0, y1) < my:
+            continue
+        if y0 == y1:
+            ix, end = (x0, i) if x0 <= x1 else (x1, (i + 1) % outer.shape[0])
+            if ix < mx:
+                continue
+        else:
+            ix = x0 + (my - y0) * (x1 - x0) / (y1 - y0)
+            if ix < mx:
+                continue
+            end = i if x0 > x1 else (i + 1) % outer.shape[0]
+            if (ix, my) == (x0, y0):
+                end = i
+            elif (ix, my) == (x1, y1):
+                end = (i + 1) % outer.shape[0]
+        if ix < best:
+            best, visible = ix, end
+    if visible is None:
+        raise ValueError("A hole of the board is not inside its outline")
+
+    # Reflex vertices inside the triangle (hole vertex, ray crossing, visible end) hide the end from the hole
+    corner = np.array([mx, my])
+    hit = np.array([best, my])
+    end = outer[visible]
+    reflex = cross(np.roll(outer, 1, axis=0), outer, following) < 0
+    triangle = (corner, hit, end) if cross(corner, hit, end) > 0 else (corner, end, hit)
+    inside = reflex & (cross(triangle[0], triangle[1], outer) > 0) & (cross(triangle[1], triangle[2], outer) > 0) & \
+        (cross(triangle[2], triangle[0], outer) > 0)
+    inside[visible] = False
+    if inside.any():
+        candidates = np.flatnonzero(inside)
+        offset = outer[candidates] - corner
+        angle = np.abs(np.arctan2(offset[:, 1], offset[:, 0]))
+        order = np.lexsort((np.hypot(offset[:, 0], offset[:, 1]), angle))
+        visible = int(candidates[order[0]])
+    return np.concatenate((outer[:visible + 1], hole[m:], hole[:m + 1], outer[visible:]))
+
+
+def clip_ears(points):
+    """Counter-clockwise triangles (index triples into points) of a counter-clockwise polygon without holes
+
+    A corner is an ear when it is convex and no other vertex lies in or on the triangle it cuts off, so no vertex
+    ever ends up in the middle of a triangle's edge. Copies of a corner made by a bridge do not count."""
+    remaining = list(range(points.shape[0]))
+    triangles = []
+    position = 0
+    while len(remaining) > 3:
+        count = len(remaining)
+        for attempt in range(count):
+            k = (position + attempt) % count
+            i, j, l = remaining[k - 1], remaining[k], remaining[(k + 1) % count]
+            a, b, c = points[i], points[j], points[l]
+            if cross(a, b, c) <= 0:
+                continue
+            others = points[remaining]
+            corner = np.all(others == a, axis=1) | np.all(others == b, axis=1) | np.all(others == c, axis=1)
+            blocked = (cross(a, b, others) >= 0) & (cross(b, c, others) >= 0) & (cross(c, a, others) >= 0) & ~corner
+            if not blocked.any():
+                triangles.append((i, j, l))
+                del remaining[k]
+                position = k
+                break
+        else:
+            if abs(signed_area(points[remaining])) > 0:
+                raise ValueError("Could not triangulate the board, its outlines must be simple and not touch")
+            # Only collinear vertices are left
+            return triangles
+    if cross(*points[remaining]) > 0:
+        triangles.append(tuple(remaining))
+    return triangles
+
+
+def in_circle(a, b, c, d):
+    """Whether d is clearly inside the circle through the counter-clockwise triangle a, b, c
+
+    Points on the circle (up to rounding) are not inside, so cocircular vertices never flip back and forth."""
+    adx, ady = a[0] - d[0], a[1] - d[1]
+    bdx, bdy = b[0] - d[0], b[1] - d[1]
+    cdx, cdy = c[0] - d[0], c[1] - d[1]
+    ad, bd, cd = adx * adx + ady * ady, bdx * bdx + bdy * bdy, cdx * cdx + cdy * cdy
+    determinant = ad * (bdx * cdy - cdx * bdy) - bd * (adx * cdy - cdx * ady) + cd * (adx * bdy - bdx * ady)
+    scale = ad * (abs(bdx * cdy) + abs(cdx * bdy)) + bd * (abs(adx * cdy) + abs(cdx * ady)) + \
+        cd * (abs(adx * bdy) + abs(bdx * ady))
+    return determinant > 1e-10 * scale
+
+
+def flip_edges(triangles, walls):
+    """Flip the diagonals that are not walls until every pair of triangles is Delaunay (Lawson's flips)
+
+    Ear clipping leaves long slivers fanning out of a few vertices, which a walk would cross one after the other.
+    The flipped mesh has the same outline and walls with triangles as round as they can be. triangles is a list of
+    counter-clockwise corner tuples, updated in place, walls a set of the (start, end) pairs that must stay."""
+    owner = {}
+    for t, (a, b, c) in enumerate(triangles):
+        owner[a, b] = owner[b, c] = owner[c, a] = t
+    pending = [edge for edge in owner if edge not in walls]
+    while pending:
+        u, v = pending.pop()
+        if (u, v) not in owner or (v, u) not in owner:
+            continue
+        first, second = owner[u, v], owner[v, u]
+        p = next(corner for corner in triangles[first] if corner != u and corner != v)
+        q = next(corner for corner in triangles[second] if corner != u and corner != v)
+        # Triangles (u, v, p) and (v, u, q) become (u, q, p) and (q, v, p), which must both turn counter-clockwise
+        if not in_circle(u, v, p, q) or cross(*np.array((u, q, p))) <= 0 or cross(*np.array((q, v, p))) <= 0:
+            continue
+        triangles[first] = (u, q, p)
+        triangles[second] = (q, v, p)
+        del owner[u, v], owner[v, u]
+        owner[u, q] = owner[q, p] = owner[p, u] = first
+        owner[q, v] = owner[v, p] = owner[p, q] = second
+        pending.extend(edge for edge in ((u, q), (q, v), (v, p), (p, u)) if edge not in walls)
+
+
+def triangulate(polygon):
+    """Triangles (triangles, 3, 2) covering the inside of the board, counter-clockwise
+
+    The inside is where the ray test of the edge kernels counts an odd number of crossings. An outline inside an even
+    number of others bounds a part of the board, the outlines right inside it are its holes (which can hold islands
+    of their own, bounding parts again). The ear clipped triangles are then flipped to a Delaunay triangulation."""
+    loops = outlines(polygon)
+    depth = [sum(encloses(other, loop[0]) for other in loops if other is not loop) for loop in loops]
+    triangles = []
+    for k, loop in enumerate(loops):
+        if depth[k] % 2 == 1:
+            continue
+        outer = loop if signed_area(loop) > 0 else loop[::-1]
+        holes = [hole if signed_area(hole) < 0 else hole[::-1] for h, hole in enumerate(loops)
+                 if depth[h] == depth[k] + 1 and encloses(loop, hole[0])]
+        # Rightmost holes first, so every bridge can see past the ones already joined
+        for hole in sorted(holes, key=lambda hole: -np.max(hole[:, 0])):
+            outer = bridge(outer, hole)
+        points = list(map(tuple, outer.tolist()))
+        triangles.extend(tuple(points[corner] for corner in corners) for corners in clip_ears(outer))
+    walls = set()
+    for x0, y0, x1, y1 in polygon.tolist():
+        walls.update((((x0, y0), (x1, y1)), ((x1, y1), (x0, y0))))
+    flip_edges(triangles, walls)
+    return np.array(triangles, np.float64).reshape(-1, 3, 2)
+
+
+class TriangleMesh:
+    """Triangulated board walked from each ball's triangle of the previous call, a drop-in replacement for EdgeKernel
+
+    Balls move little between frames, so most of them are still in the same triangle or one next to it: a walk
+    steps across the edge the ball is furthest beyond until the ball is inside, a constant amount of work per ball
+    instead of a test against every edge. Walking out of the mesh means crossing a wall. Balls that walk out, get
+    within rounding of a wall or a vertex, or are level with a vertex (where the ray test is degenerate) go through
+    the exact EdgeIndex, so the parity and nearest side always match EdgeKernel. num_intersections only keeps the
+    parity for the others, and nearest_side is 0 for balls inside, like EdgeIndex.
+
+    The triangles of the last call are the starting points of the next one when it has as many balls, other calls
+    start from a coarse grid of triangles."""
+    def __init__(self, polygon, As, Bs, Cs, lower, upper, max_walk=MAX_WALK, chunk_size=None, dtype=np.float64):
+        polygon = np.asarray(polygon, np.float64)
+        self.refine = EdgeIndex(polygon, As, Bs, Cs, lower, upper, chunk_size=chunk_size, dtype=dtype)
+        self.max_walk = max_walk
+        self.triangles = triangulate(polygon)
+        corners = self.triangles
+        ends = np.roll(corners, -1, axis=1)
+
+        # Triangle edges k (corner k to corner k + 1) with the same ends, the other way round, are neighbours
+        walls = set()
+        for x0, y0, x1, y1 in polygon.tolist():
+            walls.update(((x0, y0, x1, y1), (x1, y1, x0, y0)))
+        sides = {}
+        for t, k in np.ndindex(corners.shape[:2]):
+            sides[tuple(corners[t, k].tolist() + ends[t, k].tolist())] = t * 3 + k
+        # Walls have no neighbour, walking across one leaves the mesh
+        self.neighbours = np.full(corners.shape[:2], -1, np.int64)
+        for t, k in np.ndindex(corners.shape[:2]):
+            key = tuple(corners[t, k].tolist() + ends[t, k].tolist())
+            twin = sides.get(key[2:] + key[:2])
+            if twin is not None and key not in walls:
+                self.neighbours[t, k] = twin // 3
+
+        x0, x1 = np.min(polygon[:, ::2]), np.max(polygon[:, ::2])
+        y0, y1 = np.min(polygon[:, 1::2]), np.max(polygon[:, 1::2])
+        self.cell_size = max(x1 - x0, y1 - y0) / START_RESOLUTION
+        self.x0, self.y0 = x0, y0
+        self.nx = int(np.ceil((x1 - x0) / self.cell_size)) + 1
+        self.ny = int(np.ceil((y1 - y0) / self.cell_size)) + 1
+        # Walks of new balls start from the triangle whose centroid is nearest their cell's centre
+        ix, iy = np.divmod(np.arange(self.nx * self.ny), self.ny)
+        centres = np.column_stack((x0 + (ix + 0.5) * self.cell_size, y0 + (iy + 0.5) * self.cell_size))
+        centroids = np.mean(corners, axis=1)
+        self.start = np.argmin(np.sum((centres[:, None] - centroids) ** 2, axis=2), axis=1)
+        self.vertex_ys = np.unique(polygon[:, 1::2])
+        self.prepare()
+
+    def prepare(self):
+        # (triangles, 3 edges, 3) coefficients of the signed distance to the line of each triangle edge, a x + b y + c,
+        # positive on the triangle's side: one gather per ball and step of the walk
+        corners = self.triangles
+        direction = np.roll(corners, -1, axis=1) - corners
+        length = np.maximum(np.hypot(direction[..., 0], direction[..., 1]), np.finfo(np.float64).tiny)
+        a = -direction[..., 1] / length
+        b = direction[..., 0] / length
+        self.coefficients = np.stack((a, b, -(a * corners[..., 0] + b * corners[..., 1])), axis=2)
+        # Closer than this to an edge or a vertex, the ray test and the walk may round differently
+        self.margin = 1e-9 * max(np.max(np.abs(corners), initial=0), self.cell_size)
+        self.hints = np.zeros(0, np.int64)
+
+    def arrays(self):
+        """Everything the mesh needs at run time, as arrays that can be saved and handed back to from_arrays"""
+        return {'mesh_triangles': self.triangles, 'mesh_neighbours': self.neighbours, 'mesh_start': self.start, 'mesh_grid': np.array([self.x0, self.y0, self.cell_size]),
+                'mesh_shape': np.array([self.nx, self.ny, self.max_walk], np.int64),
+                'mesh_vertex_ys': self.vertex_ys}
+
+    @classmethod
+    def from_arrays(cls, refine, arrays):
+        """Rebuild a mesh around the given EdgeIndex without triangulating the board again"""
+        mesh = cls.__new__(cls)
+        mesh.refine = refine
+        mesh.triangles = arrays['mesh_triangles']
+        mesh.neighbours = arrays['mesh_neighbours']
+        mesh.start = arrays['mesh_start']
+        mesh.x0, mesh.y0, mesh.cell_size = arrays['mesh_grid'].tolist()
+        mesh.nx, mesh.ny, mesh.max_walk = arrays['mesh_shape'].tolist()
+        mesh.vertex_ys = arrays['mesh_vertex_ys']
+        mesh.prepare()
+        return mesh
+
+    def distances(self, x, triangle):
+        """(balls, 3) signed distances of every ball to the edges of triangle (one per ball, or all of them)"""
+        coefficients = self.coefficients[triangle]
+        return coefficients[..., 0] * x[:, 0:1] + coefficients[..., 1] * x[:, 1:2] + coefficients[..., 2]
+
+    def start_triangles(self, x):
+        ix = np.clip(np.floor((x[:, 0] - self.x0) / self.cell_size), 0, self.nx - 1).astype(np.int64)
+        iy = np.clip(np.floor((x[:, 1] - self.y0) / self.cell_size), 0, self.ny - 1).astype(np.int64)
+        return self.start[ix * self.ny + iy]
+
+    def walk(self, x, triangle):
+        """Triangle of every ball, walking from the given ones, and the signed distance to its nearest edge
+
+        The distance is below -margin for the balls that walked out of the mesh or ran out of steps, their triangle
+        is then the last one visited."""
+        triangle = triangle.copy()
+        closest = np.empty(x.shape[0])
+        walking = np.arange(x.shape[0])
+        p = x
+        for _ in range(self.max_walk):
+            t = triangle[walking]
+            distance = self.distances(p, t)
+            k = np.argmin(distance, axis=1)
+            closest[walking] = distance[np.arange(walking.shape[0]), k]
+            beyond = closest[walking] < -self.margin
+            walking, t, k = walking[beyond], t[beyond], k[beyond]
+            following = self.neighbours[t, k]
+            walking = walking[following >= 0]
+            if walking.shape[0] == 0:
+                break
+            triangle[walking] = following[following >= 0]
+            p = x[walking]
+        return triangle, closest
+
+    def locate(self, x, chunk_size=1024):
+        """Triangle of every ball searched over the whole mesh, -1 for balls outside it"""
+        found = np.full(x.shape[0], -1, np.int64)
+        for start in range(0, x.shape[0], chunk_size):
+            stop = min(start + chunk_size, x.shape[0])
+            px = x[start:stop, 0, None, None]
+            py = x[start:stop, 1, None, None]
+            distance = self.coefficients[..., 0] * px + self.coefficients[..., 1] * py + self.coefficients[..., 2]
+            inside = np.all(distance >= -self.margin, axis=2)
+            found[start:stop] = np.where(inside.any(axis=1), np.argmax(inside, axis=1), -1)
+        return found
+
+    def __call__(self, x, num_intersections=None, nearest_side=None):
+        n = x.shape[0]
+        if num_intersections is None:
+            num_intersections = np.zeros(n, np.int32)
+        if nearest_side is None:
+            nearest_side = np.zeros(n, np.int32)
+        if self.hints.shape[0] != n:
+            self.hints = self.start_triangles(x)
+
+        triangle, closest = self.walk(x, self.hints)
+        lost = closest < -self.margin
+        # A wall or vertex within margin of a ball inside a triangle is one of its edges or corners, so the balls that
+        # close to any edge of their triangle are refined (those next to an inner edge too, which is rare enough)
+        row = np.minimum(np.searchsorted(self.vertex_ys, x[:, 1]), self.vertex_ys.shape[0] - 1)
+        level = self.vertex_ys[row] == x[:, 1]
+        num_intersections[:] = 1
+        nearest_side[:] = 0
+
+        # Exact refinement next to the walls and for balls that walked out
+        unsure = np.flatnonzero((closest <= self.margin) | level)
+        if unsure.shape[0] > 0:
+            count, side = self.refine(x[unsure])
+            num_intersections[unsure] = count
+            nearest_side[unsure] = side
+            # A walk can leave through a wall and find the ball still on the board, past a corner or in another part
+            # of it, those balls are located from scratch
+            found = unsure[lost[unsure] & (count % 2 == 1)]
+            if found.shape[0] > 0:
+                located = self.locate(x[found])
+                triangle[found] = np.where(located >= 0, located, triangle[found])
+        self.hints = triangle
+        return num_intersections, nearest_side